@@ -0,0 +1,219 @@
+# Asynchronous bulk URL fetcher.
+#
+# Fetches a list or stream of URLs with asyncio, keeping at most `concurrency` requests in flight overall and at most
+# `per_host` connections to any one host. Connections are kept alive and reused for later URLs on the same host.
+# Results are yielded as they complete, with their timings, e.g. against a local server:
+#
+#     python http_server.py --mode async &
+#     python bulk_fetch.py --input urls.txt > results.jsonl
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from http_client import (build_request, can_reuse, decode_body, host_header, is_encoded, keep_alive_timeout,
+                         split_url, with_accept_encoding)
+from http_parser import BadResponse, ResponseParser
+
+
+# Outcome of fetching one URL. On failure status is None and error says why.
+class FetchResult:
+    def __init__(self, url, status=None, body=b"", seconds=0.0, error=None):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.seconds = seconds
+        self.error = error
+
+
+# asyncio counterpart of http_client.Connection
+class AsyncConnection:
+    def __init__(self, host, port, reader, writer):
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.parser = ResponseParser()
+        self.idle_since = time.monotonic()
+        self.idle_timeout = None
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(host, port, reader, writer)
+
+    async def request(self, method, path, headers=None):
+        self.parser.expect(method)
+        request = build_request(method, host_header(self.host, self.port), path, with_accept_encoding(headers))
+        self.writer.write(request)
+        await self.writer.drain()
+        while True:
+            response = self.parser.next_response()
+            if response is not None:
+                break
+            data = await self.reader.read(65536)
+            if not data:
+                response = self.parser.feed_eof()
+                if response is None:
+                    raise ConnectionError("connection closed before a response was received")
+                break
+            self.parser.feed(data)
+        if is_encoded(method, response):
+            decode_body(response, self.parser.max_body_bytes)
+        self.idle_since = time.monotonic()
+        self.idle_timeout = keep_alive_timeout(response)
+        return response
+
+    def is_healthy(self, max_idle):
+        idle_timeout = max_idle if self.idle_timeout is None else min(max_idle, self.idle_timeout)
+        return (not self.reader.at_eof() and not self.writer.is_closing() and not self.parser.in_message()
+                and time.monotonic() - self.idle_since < idle_timeout)
+
+    def close(self):
+        self.writer.close()
+
+
+class BulkFetcher:
+    def __init__(self, concurrency=100, per_host=8, timeout=30, idle_timeout=30):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.host_slots = {}  # (host, port) -> semaphore limiting connections to that host
+        self.idle = {}  # (host, port) -> idle connections
+
+    def checkout(self, key):
+        idle = self.idle.get(key)
+        while idle:
+            connection = idle.pop()
+            if connection.is_healthy(self.idle_timeout):
+                return connection
+            connection.close()
+        return None
+
+    # Send a request on an idle connection to the host if there is one, otherwise on a new one. A reused connection
+    # the server has just closed gets the request retried once on a new connection.
+    async def request(self, host, port, path, method):
+        key = (host, port)
+        connection = self.checkout(key)
+        if connection is not None:
+            try:
+                response = await connection.request(method, path)
+            except BaseException as e:
+                connection.close()
+                if not isinstance(e, (OSError, BadResponse)) or connection.parser.in_message():
+                    raise
+            else:
+                return connection, response
+        connection = await AsyncConnection.open(host, port)
+        try:
+            return connection, await connection.request(method, path)
+        except BaseException:
+            connection.close()
+            raise
+
+    async def fetch(self, url, method="GET"):
+        started = time.perf_counter()
+        try:
+            host, port, path = split_url(url)
+            key = (host, port)
+            slots = self.host_slots.setdefault(key, asyncio.Semaphore(self.per_host))
+            async with slots:
+                connection, response = await asyncio.wait_for(self.request(host, port, path, method), self.timeout)
+                if can_reuse(response) and connection.is_healthy(self.idle_timeout):
+                    self.idle.setdefault(key, []).append(connection)
+                else:
+                    connection.close()
+        except (OSError, ValueError, BadResponse, asyncio.TimeoutError) as e:
+            return FetchResult(url, seconds=time.perf_counter() - started, error=str(e) or type(e).__name__)
+        return FetchResult(url, response.status, bytes(response.body), time.perf_counter() - started)
+
+    # Fetch every URL from a list, iterator or async iterator, yielding results as they complete. URLs are only
+    # taken from the source as slots free up, so a long stream is never read ahead.
+    async def fetch_all(self, urls):
+        if hasattr(urls, "__aiter__"):
+            source = urls.__aiter__()
+            next_url = source.__anext__
+        else:
+            source = iter(urls)
+
+            async def next_url():
+                try:
+                    return next(source)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.concurrency:
+                try:
+                    url = await next_url()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(self.fetch(url)))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    def close(self):
+        for idle in self.idle.values():
+            for connection in idle:
+                connection.close()
+        self.idle.clear()
+
+
+# URLs from the command line, or one per line from a file or stdin, read lazily. Lines are read on a worker thread,
+# so a slow producer on a pipe doesn't stall the fetches in flight.
+async def read_urls(args):
+    if args.urls:
+        for url in args.urls:
+            yield url
+        return
+    source = sys.stdin if args.input in (None, "-") else open(args.input)
+    with source:
+        while True:
+            line = await asyncio.to_thread(source.readline)
+            if not line:
+                break
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+async def run(args):
+    fetcher = BulkFetcher(args.concurrency, args.per_host, args.timeout)
+    started = time.perf_counter()
+    count = errors = total_bytes = 0
+    try:
+        async for result in fetcher.fetch_all(read_urls(args)):
+            count += 1
+            errors += result.error is not None
+            total_bytes += len(result.body)
+            print(json.dumps({"url": result.url, "status": result.status, "bytes": len(result.body),
+                              "ms": round(result.seconds * 1000, 3), "error": result.error}))
+    finally:
+        fetcher.close()
+    elapsed = time.perf_counter() - started
+    print(f"{count} URLs in {elapsed:.2f} s ({count / elapsed:.1f}/s), {total_bytes} bytes, {errors} errors",
+          file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch many URLs concurrently")
+    parser.add_argument("urls", nargs="*", help="URLs to fetch; read from --input if none are given")
+    parser.add_argument("--input", help="file with one URL per line, - for stdin (the default)")
+    parser.add_argument("--concurrency", type=int, default=100, help="requests in flight at once")
+    parser.add_argument("--per-host", type=int, default=8, help="connections per host")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds allowed per request")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,47 @@
-import socket
+import argparse
+
+from http_cache import DiskCache
+from http_client import ConnectionPool, split_url
 
 # Host and port details
 host = "gaia.cs.umass.edu"
 port = 80
-request = "GET /wireshark-labs/INTRO-wireshark-file1.html HTTP/1.1\r\nHost:gaia.cs.umass.edu\r\n\r\n"
+path = "/wireshark-labs/INTRO-wireshark-file1.html"
+
+parser = argparse.ArgumentParser(description="Fetch files and print them")
+parser.add_argument("urls", nargs="*", default=[f"http://{host}:{port}{path}"])
+parser.add_argument("--pipeline", action="store_true",
+                    help="send the requests for each host back to back on one connection")
+parser.add_argument("--cache-dir", help="keep responses in this directory and reuse them while they are fresh")
+parser.add_argument("--cache-bytes", type=int, default=256 * 1024 * 1024, help="size limit of the cache directory")
+args = parser.parse_args()
 
-# Create a socket and connect
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-    client_socket.connect((host, port)) # Connecting to host and port number
-    client_socket.sendall(request.encode())  # Send the GET request
-    response = client_socket.recv(4096)  # Receive response (small file)
 
 # Print the server's response
-print(response.decode(errors='ignore'))
+def print_response(response):
+    print(f"{response.version} {response.status} {response.reason}")
+    print(response.body.decode(errors='ignore'))
+
+
+# URLs on the same host are fetched over one kept-alive connection
+pool = ConnectionPool()
+cache = DiskCache(args.cache_dir, args.cache_bytes) if args.cache_dir else None
+try:
+    if cache is not None:
+        for url in args.urls:
+            host, port, path = split_url(url)
+            print_response(cache.fetch(pool, host, path, port))  # Only goes to the network if stale or missing
+    elif args.pipeline:
+        by_host = {}
+        for url in args.urls:
+            host, port, path = split_url(url)
+            by_host.setdefault((host, port), []).append(path)
+        for (host, port), paths in by_host.items():
+            for response in pool.pipeline(host, paths, port):  # Send all the GET requests, then read the responses
+                print_response(response)
+    else:
+        for url in args.urls:
+            host, port, path = split_url(url)
+            print_response(pool.request(host, path, port))  # Send the GET request
+finally:
+    pool.close()
@@ -1,25 +1,101 @@
-import socket
+import argparse
+from collections import deque
+
+from http_client import fetch, segmented_download, split_url
 
 # Host and port details
 host = "gaia.cs.umass.edu"
 port = 80
-request = "GET /wireshark-labs/HTTP-wireshark-file3.html HTTP/1.1\r\nHost:gaia.cs.umass.edu\r\n\r\n"
-
-# Create a socket and connect
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-    client_socket.connect((host, port))
-    client_socket.sendall(request.encode())  # Send the GET request
-    
-    response = b""  # Use a bytes object for concatenation
-    while True:
-        chunk = client_socket.recv(4096)  # Read in chunks
-        if not chunk:
-            break  # Connection closed
-        response += chunk
-
-# Print the first and last few lines of the response
-response_text = response.decode(errors='ignore')
-lines = response_text.splitlines()
-print("\n".join(lines[:10]))  # First 10 lines
-print("...\n")
-print("\n".join(lines[-10:]))  # Last 10 lines
+path = "/wireshark-labs/HTTP-wireshark-file3.html"
+
+
+# Keeps the first and last `count` lines of a body fed to it piece by piece. Lines in between are counted and
+# dropped, so memory stays at O(count) lines however large the body is. Overlong lines are cut at max_line_bytes.
+class LinePreview:
+    def __init__(self, count, max_line_bytes=4096):
+        self.count = count
+        self.max_line_bytes = max_line_bytes
+        self.first = []
+        self.last = deque(maxlen=count)  # Ring buffer of the most recent lines
+        self.partial = bytearray()  # Line still being received
+        self.lines = 0
+
+    def add_line(self, line):
+        self.lines += 1
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        if len(self.first) < self.count:
+            self.first.append(line)
+        else:
+            self.last.append(line)
+
+    def add_partial(self, data):
+        room = self.max_line_bytes - len(self.partial)
+        if room > 0:
+            self.partial += data[:room]
+
+    def feed(self, view):
+        data = bytes(view)
+        newline = data.find(b"\n")
+        if newline == -1:
+            self.add_partial(data)
+            return
+
+        # Finish the line that was in progress
+        self.add_partial(data[:newline])
+        self.add_line(bytes(self.partial))
+        self.partial.clear()
+
+        start = newline + 1
+        last_newline = data.rfind(b"\n")
+        while len(self.first) < self.count and start <= last_newline:
+            end = data.find(b"\n", start)
+            self.add_line(data[start:end][:self.max_line_bytes])
+            start = end + 1
+
+        # Only the final `count` complete lines of this piece can still end up in the tail
+        if start <= last_newline:
+            skipped = data.count(b"\n", start, last_newline)
+            tail = data[start:last_newline].rsplit(b"\n", self.count)
+            if len(tail) > self.count:
+                tail = tail[1:]
+            self.lines += skipped + 1 - len(tail)
+            for line in tail:
+                self.add_line(line[:self.max_line_bytes])
+
+        self.add_partial(data[last_newline + 1:])
+
+    def finish(self):
+        if self.partial:
+            self.add_line(bytes(self.partial))
+            self.partial.clear()
+
+    def print(self):
+        print("\n".join(line.decode(errors='ignore') for line in self.first))  # First lines
+        print("...\n")
+        print("\n".join(line.decode(errors='ignore') for line in self.last))  # Last lines
+
+
+parser = argparse.ArgumentParser(description="Fetch a large file and preview it, or save it")
+parser.add_argument("url", nargs="?", default=f"http://{host}:{port}{path}")
+parser.add_argument("output", nargs="?", help="save the body to this file instead of previewing it")
+parser.add_argument("--lines", type=int, default=10, help="lines to show from each end of the body")
+parser.add_argument("--connections", type=int, default=4,
+                    help="parallel connections for saving a file, each fetching byte ranges of it")
+args = parser.parse_args()
+host, port, path = split_url(args.url)
+
+if args.output:
+    # Fetch byte ranges in parallel straight into the file, or stream it in one piece if the server can't do ranges
+    response = segmented_download(host, path, args.output, port, args.connections)
+    print(f"HTTP/1.1 {response.status} {response.reason}: saved to {args.output}")
+else:
+    # Preview the body as it streams in. The body is read until its Content-Length or final chunk, so we don't wait
+    # for the server to close.
+    preview = LinePreview(args.lines)
+    response = fetch(host, path, port, on_body=preview.feed)
+    preview.finish()
+
+    # Print the first and last few lines of the response
+    print(f"HTTP/1.1 {response.status} {response.reason} ({preview.lines} lines)")
+    preview.print()
@@ -0,0 +1,359 @@
+# Load generator and latency benchmark for http_server.py.
+#
+# Starts the server on loopback (or targets one that is already running), drives it from `concurrency` client threads
+# and reports requests/sec, bytes/sec and latency percentiles, as text or as JSON for tracking regressions.
+#
+# Requests go out either over raw sockets with a minimal loop, which measures the server, or through
+# http_client.ConnectionPool like get_file.py and get_larger_file.py, which measures the server and that client
+# together.
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http_client import ConnectionPool, can_reuse
+from http_client import read_response as read_http_response
+from http_parser import BadResponse, ResponseParser
+
+server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "http_server.py")
+
+
+# Result of one client thread
+class WorkerStats:
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.connections = 0
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start listening on {host}:{port}")
+
+
+# Write one file per payload size into a temporary document root
+def make_payloads(root, sizes):
+    paths = []
+    for size in sizes:
+        name = f"payload_{size}.bin"
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(os.urandom(size))
+        paths.append("/" + name)
+    return paths
+
+
+# Read one response and return the number of body bytes, which are counted rather than kept, and whether the server
+# is closing. Content-Length bodies are read here directly, as that path is most of what the raw client does and has
+# to stay cheap. Any other framing, such as the chunked bodies of directory listings and streamed or proxied
+# responses, is handed to the shared http_parser.ResponseParser.
+def read_response(sock, buffer):
+    while True:
+        head_end = buffer.find(b"\r\n\r\n")
+        if head_end != -1:
+            break
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed before the response head")
+        buffer += chunk
+
+    head = bytes(buffer[:head_end]).decode("iso-8859-1").lower()
+    status = head.split(" ", 2)[1:2]
+    if status not in (["200"], ["206"], ["304"]):
+        raise ConnectionError(head.split("\r\n")[0])
+    length = None
+    for line in head.split("\r\n")[1:]:
+        name, _, value = line.partition(":")
+        if name == "transfer-encoding":
+            return read_parsed_response(sock, buffer)
+        if name == "content-length":
+            length = int(value)
+    if length is None:
+        if status == ["304"]:
+            length = 0
+        else:
+            return read_parsed_response(sock, buffer)
+
+    del buffer[:head_end + 4]
+    received = min(len(buffer), length)
+    del buffer[:received]
+    while received < length:
+        chunk = sock.recv(min(1024 * 1024, length - received))
+        if not chunk:
+            raise ConnectionError("connection closed mid-body")
+        received += len(chunk)
+    return received, "connection: close" in head
+
+
+def read_parsed_response(sock, buffer):
+    received = 0
+
+    def count(view):
+        nonlocal received
+        received += len(view)
+
+    parser = ResponseParser()
+    parser.on_body = count
+    parser.expect("GET")
+    parser.feed(buffer)
+    buffer.clear()
+    response = read_http_response(sock, parser)
+    buffer += parser.buffer[parser.start:parser.end]  # Anything the server sent past the response
+    return received, not can_reuse(response)
+
+
+# Sends requests on its own socket, reconnecting every `requests_per_connection` requests
+class RawClient:
+    def __init__(self, host, port, requests_per_connection):
+        self.host = host
+        self.port = port
+        self.requests_per_connection = requests_per_connection
+        self.sock = None
+        self.buffer = bytearray()
+        self.served = 0
+        self.connections = 0
+
+    # GET path and return the number of body bytes
+    def get(self, path):
+        last = self.served + 1 >= self.requests_per_connection
+        request = (f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                   f"Connection: {'close' if last else 'keep-alive'}\r\n\r\n").encode()
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection((self.host, self.port))
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.connections += 1
+            self.sock.sendall(request)
+            length, closed = read_response(self.sock, self.buffer)
+        except BaseException:
+            self.close()
+            raise
+        self.served += 1
+        if closed or self.served >= self.requests_per_connection:
+            self.close()
+        return length
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.buffer.clear()
+        self.served = 0
+
+
+# ConnectionPool that counts the connections it opens
+class CountingPool(ConnectionPool):
+    def __init__(self, timeout=30):
+        super().__init__(max_size=1, timeout=timeout)
+        self.connections = 0
+
+    def checkout(self, host, port):
+        connection = super().checkout(host, port)
+        if connection is None:
+            self.connections += 1
+        return connection
+
+
+# Sends requests through http_client, the code path of get_file.py and get_larger_file.py: pooled keep-alive
+# connections, the full response parser and gzip decoding
+class PoolClient:
+    def __init__(self, host, port, requests_per_connection):
+        self.host = host
+        self.port = port
+        self.requests_per_connection = requests_per_connection
+        self.pool = CountingPool()
+        self.served = 0
+
+    @property
+    def connections(self):
+        return self.pool.connections
+
+    def get(self, path):
+        received = 0
+
+        def count(view):
+            nonlocal received
+            received += len(view)
+
+        self.served += 1
+        headers = None
+        if self.served >= self.requests_per_connection:
+            headers = {"Connection": "close"}
+            self.served = 0
+        try:
+            response = self.pool.request(self.host, path, self.port, headers=headers, on_body=count)
+        except BaseException:
+            self.served = 0
+            raise
+        if response.status not in (200, 206, 304):
+            raise ConnectionError(f"{response.status} {response.reason}")
+        return received
+
+    def close(self):
+        self.pool.close()
+
+
+clients = {"raw": RawClient, "http_client": PoolClient}
+
+
+# Client thread: send requests until the deadline or the shared request budget runs out
+def run_worker(client, paths, deadline, budget, budget_lock, stats, start_index):
+    index = start_index
+    try:
+        while time.monotonic() < deadline:
+            with budget_lock:
+                if budget[0] == 0:
+                    break
+                budget[0] -= 1
+
+            path = paths[index % len(paths)]
+            index += 1
+            started = time.perf_counter()
+            try:
+                length = client.get(path)
+            except (OSError, BadResponse):
+                stats.errors += 1
+                continue
+            stats.latencies.append(time.perf_counter() - started)
+            stats.bytes += length
+    finally:
+        client.close()
+        stats.connections = client.connections
+
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def run_benchmark(host, port, paths, concurrency, requests_per_connection, duration, total_requests, client="raw"):
+    budget = [total_requests if total_requests else -1]  # -1 never reaches 0, so only the deadline applies
+    budget_lock = threading.Lock()
+    stats = [WorkerStats() for _ in range(concurrency)]
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [threading.Thread(target=run_worker, daemon=True,
+                                args=(clients[client](host, port, requests_per_connection), paths, deadline, budget,
+                                      budget_lock, stats[i], i))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(latency for s in stats for latency in s.latencies)
+    total_bytes = sum(s.bytes for s in stats)
+    return {
+        "requests": len(latencies),
+        "errors": sum(s.errors for s in stats),
+        "connections": sum(s.connections for s in stats),
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "bytes_per_sec": round(total_bytes / elapsed),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p90": round(percentile(latencies, 90) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+def print_report(report):
+    result = report["result"]
+    print(f"{result['requests']} requests in {result['seconds']} s over {result['connections']} connections, "
+          f"{result['errors']} errors")
+    print(f"Requests/sec: {result['requests_per_sec']}")
+    print(f"Bytes/sec:    {result['bytes_per_sec']}")
+    latency = result["latency_ms"]
+    print(f"Latency (ms): p50 {latency['p50']}  p90 {latency['p90']}  p99 {latency['p99']}  max {latency['max']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark http_server.py on loopback")
+    parser.add_argument("--target", help="host:port of a running server; by default one is started")
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads")
+    parser.add_argument("--requests-per-connection", type=int, default=100,
+                        help="requests sent on a connection before reconnecting, 1 disables reuse")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--sizes", default="",
+                        help="comma separated payload sizes in bytes; empty requests the built-in page")
+    parser.add_argument("--path", action="append", default=[], help="path to request on a --target server")
+    parser.add_argument("--client", choices=sorted(clients), default="raw",
+                        help="raw sockets, or http_client's ConnectionPool as used by get_file.py")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER,
+                        help="arguments after -- are passed to http_server.py")
+    args = parser.parse_args()
+    server_args = args.server_args[1:] if args.server_args[:1] == ["--"] else args.server_args
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    server = None
+    with tempfile.TemporaryDirectory() as root:
+        if args.target:
+            host, _, target_port = args.target.rpartition(":")
+            port = int(target_port)
+            paths = args.path or ["/"]
+        else:
+            host, port = "127.0.0.1", free_port()
+            paths = make_payloads(root, sizes) if sizes else ["/"]
+            command = [sys.executable, server_script, "--host", host, "--port", str(port)]
+            if sizes:
+                command += ["--root", root]
+            server = subprocess.Popen(command + server_args, stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port(host, port)
+            result = run_benchmark(host, port, paths, args.concurrency, args.requests_per_connection,
+                                   args.duration, args.requests, args.client)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "config": {
+            "target": args.target,
+            "server_args": server_args,
+            "concurrency": args.concurrency,
+            "requests_per_connection": args.requests_per_connection,
+            "client": args.client,
+            "duration": args.duration,
+            "requests": args.requests,
+            "sizes": sizes,
+            "paths": paths,
+        },
+        "result": result,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# Persistent on-disk cache for the fetch clients.
+#
+# Each cached URL has a metadata file (JSON: status, headers, validators, when it was stored) and a body file. Both
+# are written to a temporary file and renamed into place, and a new body gets a new name before the metadata that
+# points at it is replaced, so processes sharing the directory only ever see complete entries.
+#
+# Fresh entries (Cache-Control max-age or Expires) are served without touching the network. Stale ones are
+# revalidated with a conditional GET, and a 304 only rewrites the metadata. Hits bump the metadata file's mtime,
+# which is what LRU eviction orders by once the bodies exceed max_bytes.
+
+import email.utils
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from http_parser import ParsedResponse, hop_by_hop
+
+
+def cache_control(headers):
+    directives = {}
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+    return directives
+
+
+# Seconds after being stored that a response stays fresh, 0 if it has to be revalidated every time
+def freshness_lifetime(headers):
+    directives = cache_control(headers)
+    if "no-cache" in directives:
+        return 0
+    if directives.get("max-age", "").isdigit():
+        return int(directives["max-age"])
+    if "expires" in headers:
+        try:
+            expires = email.utils.parsedate_to_datetime(headers["expires"]).timestamp()
+            date = email.utils.parsedate_to_datetime(headers["date"]).timestamp() if "date" in headers else time.time()
+        except (TypeError, ValueError):
+            return 0
+        return max(0, int(expires - date))
+    return 0
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, rescan_seconds=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_seconds = rescan_seconds
+        self.total_bytes = None  # Size of the bodies at the last scan, plus what this process has stored since
+        self.scanned = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def meta_path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    # Write data to a temporary file in the cache directory and rename it to path in one step
+    def write_atomic(self, path, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def load(self, url):
+        meta_path = self.meta_path(url)
+        try:
+            with open(meta_path, "rb") as f:
+                meta = json.load(f)
+            with open(os.path.join(self.directory, meta["body"]), "rb") as f:
+                body = f.read()
+        except (OSError, ValueError, KeyError):
+            return None, None  # Missing, or evicted by another process while we read it
+        if meta.get("url") != url:
+            return None, None
+        try:
+            os.utime(meta_path)  # Mark as recently used
+        except OSError:
+            pass
+        return meta, body
+
+    def store(self, url, response, meta=None):
+        if meta is None:
+            body_name = uuid.uuid4().hex + ".body"
+            self.write_atomic(os.path.join(self.directory, body_name), bytes(response.body))
+            if self.total_bytes is not None:
+                self.total_bytes += len(response.body)
+            old_meta, _ = self.load(url)
+            meta = {"url": url, "status": response.status, "reason": response.reason, "body": body_name,
+                    "headers": {}}
+        else:
+            old_meta = None
+        meta["headers"].update({name: value for name, value in response.headers.items() if name not in hop_by_hop})
+        meta["stored"] = time.time()
+        self.write_atomic(self.meta_path(url), json.dumps(meta).encode())
+        if old_meta is not None and old_meta["body"] != meta["body"]:
+            if self.total_bytes is not None:
+                try:
+                    self.total_bytes -= os.stat(os.path.join(self.directory, old_meta["body"])).st_size
+                except OSError:
+                    pass
+            self.remove_file(old_meta["body"])
+        self.maybe_evict()
+
+    # Scanning means reading every metadata file, so it is only done when the running total says the bodies may be
+    # over budget. Other processes sharing the directory aren't in the total, so it is also rescanned every
+    # rescan_seconds.
+    def maybe_evict(self):
+        if (self.total_bytes is None or self.total_bytes > self.max_bytes
+                or time.time() - self.scanned > self.rescan_seconds):
+            self.evict()
+
+    def remove_file(self, name):
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    # Remove least recently used entries, plus leftovers of interrupted writes. Once over max_bytes it removes down to
+    # 90% of it, so the next few stores don't each need a scan.
+    def evict(self):
+        entries = []
+        referenced = set()
+        total = 0
+        now = time.time()
+        with os.scandir(self.directory) as scan:
+            files = list(scan)
+        for entry in files:
+            if entry.name.endswith(".json"):
+                try:
+                    with open(entry.path, "rb") as f:
+                        body = json.load(f)["body"]
+                    size = os.stat(os.path.join(self.directory, body)).st_size
+                    used = entry.stat().st_mtime
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((used, entry.path, body, size))
+                referenced.add(body)
+                total += size
+        for entry in files:
+            stale_temp = entry.name.startswith(".tmp-")
+            orphan = entry.name.endswith(".body") and entry.name not in referenced
+            try:
+                if (stale_temp or orphan) and now - entry.stat().st_mtime > 60:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+        entries.sort()
+        target = self.max_bytes if total <= self.max_bytes else self.max_bytes * 0.9
+        for used, meta_path, body, size in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(meta_path)
+            except OSError:
+                pass
+            self.remove_file(body)
+            total -= size
+        self.total_bytes = total
+        self.scanned = now
+
+    # GET url through the cache, using pool for any network request. The response's cache_status says where it came
+    # from: "hit" (fresh, no network), "revalidated" (304 from the server) or "miss".
+    def fetch(self, pool, host, path, port=80):
+        url = f"http://{host}:{port}{path}"
+        meta, body = self.load(url)
+        if meta is not None:
+            age = time.time() - meta["stored"]
+            if age < freshness_lifetime(meta["headers"]):
+                return self.cached_response(meta, body, "hit")
+
+        headers = {}
+        if meta is not None:
+            if "etag" in meta["headers"]:
+                headers["If-None-Match"] = meta["headers"]["etag"]
+            if "last-modified" in meta["headers"]:
+                headers["If-Modified-Since"] = meta["headers"]["last-modified"]
+        response = pool.request(host, path, port, headers=headers)
+
+        if response.status == 304 and meta is not None:
+            self.store(url, response, meta)
+            return self.cached_response(meta, body, "revalidated")
+        response.cache_status = "miss"
+        if response.status == 200 and "no-store" not in cache_control(response.headers):
+            self.store(url, response)
+        return response
+
+    def cached_response(self, meta, body, cache_status):
+        response = ParsedResponse("HTTP/1.1", meta["status"], meta["reason"], dict(meta["headers"]))
+        response.body = bytearray(body)
+        response.cache_status = cache_status
+        return response
@@ -0,0 +1,403 @@
+# Streaming HTTP/1.1 client used by get_file.py and get_larger_file.py.
+#
+# Responses are received with recv_into into the parser's preallocated buffer, and reading stops as soon as the
+# response is complete by its Content-Length or final chunk, so we never wait for the server to close a kept-alive
+# connection. Bodies can be streamed to a callback instead of being collected.
+#
+# ConnectionPool keeps persistent connections per host, so many small fetches from the same server share a few TCP
+# connections instead of paying for a handshake each.
+#
+# Requests ask for gzip or deflate, and encoded bodies are decompressed as they stream in, so callers always see the
+# decoded body.
+
+import mmap
+import select
+import socket
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from http_parser import BadResponse, ResponseParser
+
+
+# Split "http://host[:port]/path" into (host, port, path)
+def split_url(url):
+    parts = urlsplit(url if "//" in url else "http://" + url)
+    if parts.scheme != "http":
+        raise ValueError(f"unsupported scheme {parts.scheme}")
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    return parts.hostname, parts.port or 80, path
+
+
+def host_header(host, port):
+    return host if port == 80 else f"{host}:{port}"
+
+
+def build_request(method, host, path, headers=None):
+    request = f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+    for name, value in (headers or {}).items():
+        request += f"{name}: {value}\r\n"
+    return (request + "\r\n").encode()
+
+
+accept_encoding = "gzip, deflate"
+decoded_encodings = ("gzip", "x-gzip", "deflate")
+
+
+# Add our Accept-Encoding to request headers unless the caller set one
+def with_accept_encoding(headers):
+    headers = dict(headers or {})
+    if not any(name.lower() == "accept-encoding" for name in headers):
+        headers["Accept-Encoding"] = accept_encoding
+    return headers
+
+
+def is_encoded(method, response):
+    return (method != "HEAD" and response.status >= 200 and response.status not in (204, 304)
+            and response.headers.get("content-encoding", "").strip().lower() in decoded_encodings)
+
+
+# Undoes a response's gzip or deflate encoding as the body arrives, passing the decoded bytes to on_body, or collecting
+# them in response.body up to max_body_bytes. Output is produced in bounded pieces, so a small body that inflates to a
+# huge one can't take all the memory at once.
+class BodyDecoder:
+    def __init__(self, response, on_body, max_body_bytes):
+        self.response = response
+        self.on_body = on_body
+        self.max_body_bytes = max_body_bytes
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)  # Reads both gzip and zlib headers
+
+    def emit(self, data):
+        if not data:
+            return
+        if self.on_body is not None:
+            self.on_body(data)
+            return
+        if len(self.response.body) + len(data) > self.max_body_bytes:
+            raise BadResponse("decoded body too large")
+        self.response.body += data
+
+    def feed(self, view):
+        try:
+            while view:
+                self.emit(self.decompressor.decompress(view, 256 * 1024))
+                view = self.decompressor.unconsumed_tail
+        except zlib.error as e:
+            raise BadResponse(f"bad {self.response.headers['content-encoding']} body: {e}")
+
+    # The response is complete: check the encoded body was too, and make the headers describe the decoded body
+    def finish(self):
+        self.emit(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise BadResponse("truncated encoded body")
+        del self.response.headers["content-encoding"]
+        self.response.headers.pop("content-length", None)
+
+
+# Decode a response whose encoded body has already been collected
+def decode_body(response, max_body_bytes):
+    decoder = BodyDecoder(response, None, max_body_bytes)
+    body, response.body = response.body, bytearray()
+    decoder.feed(body)
+    decoder.finish()
+
+
+# Read the next response from sock. Bytes of a following response stay in the parser.
+def read_response(sock, parser):
+    while True:
+        response = parser.next_response()
+        if response is not None:
+            return response
+        if not parser.recv_into(sock):
+            response = parser.feed_eof()
+            if response is None:
+                raise ConnectionError("connection closed before a response was received")
+            return response
+
+
+# True if a response leaves its connection usable for another request
+def can_reuse(response):
+    connection = response.headers.get("connection", "").lower()
+    if response.version == "HTTP/1.0":
+        return "keep-alive" in connection
+    return "close" not in connection
+
+
+# Seconds the server says it keeps an idle connection, from "Keep-Alive: timeout=5, max=100", or None
+def keep_alive_timeout(response):
+    for param in response.headers.get("keep-alive", "").split(","):
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "timeout" and value.isdigit():
+            return int(value)
+    return None
+
+
+# One HTTP connection. Requests are sent one after another and their responses read from the same parser.
+class Connection:
+    def __init__(self, host, port=80, timeout=30):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.parser = ResponseParser(buffer_size=256 * 1024)
+        self.requests = 0
+        self.idle_since = time.monotonic()
+        self.idle_timeout = None  # Server's keep-alive timeout, if it sent one
+
+    def request(self, method, path, headers=None, on_body=None, on_head=None):
+        decoder = None
+
+        # Once the head shows an encoded body, route the body through a decoder
+        def head(response):
+            nonlocal decoder
+            if is_encoded(method, response):
+                decoder = BodyDecoder(response, on_body, self.parser.max_body_bytes)
+                self.parser.on_body = decoder.feed
+            if on_head is not None:
+                on_head(response)
+
+        self.requests += 1
+        self.parser.on_head = head
+        self.parser.on_body = on_body
+        self.parser.expect(method)
+        request = build_request(method, host_header(self.host, self.port), path, with_accept_encoding(headers))
+        self.sock.sendall(request)
+        response = read_response(self.sock, self.parser)
+        if decoder is not None:
+            decoder.finish()
+        self.idle_since = time.monotonic()
+        self.idle_timeout = keep_alive_timeout(response)
+        return response
+
+    # Write requests for all of paths back to back, then read the responses in order from the one receive buffer, so
+    # K requests cost about one round trip instead of K. If the server closes the connection part way (say after its
+    # per-connection request limit) the responses received so far are returned, and the caller resends the rest.
+    def pipeline(self, method, paths, headers=None):
+        host = host_header(self.host, self.port)
+        for _ in paths:
+            self.parser.expect(method)
+        self.requests += len(paths)
+        self.parser.on_head = self.parser.on_body = None
+        headers = with_accept_encoding(headers)
+        self.sock.sendall(b"".join(build_request(method, host, path, headers) for path in paths))
+
+        responses = []
+        while len(responses) < len(paths):
+            try:
+                response = read_response(self.sock, self.parser)
+            except (OSError, BadResponse):
+                if self.parser.in_message():
+                    raise
+                break
+            if is_encoded(method, response):
+                decode_body(response, self.parser.max_body_bytes)
+            responses.append(response)
+            if not can_reuse(response):
+                break
+        self.idle_since = time.monotonic()
+        if responses:
+            self.idle_timeout = keep_alive_timeout(responses[-1])
+        return responses
+
+    # A kept-alive connection has nothing to read between responses. If it is readable, the server has closed it
+    # (or sent something we did not ask for), so it cannot be reused.
+    def is_healthy(self):
+        if self.parser.in_message():
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        self.sock.close()
+
+
+# Per-host pool of persistent connections. Up to max_size idle connections are kept per (host, port). They are
+# evicted after idle_timeout seconds, or sooner if the server said so, and health checked when checked out.
+class ConnectionPool:
+    def __init__(self, max_size=8, idle_timeout=30, timeout=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle = {}  # (host, port) -> idle connections, most recently used last
+        self.lock = threading.Lock()
+
+    def expired(self, connection, now):
+        idle_timeout = self.idle_timeout
+        if connection.idle_timeout is not None:
+            idle_timeout = min(idle_timeout, connection.idle_timeout)
+        return now - connection.idle_since >= idle_timeout
+
+    # Take a healthy idle connection to host, or None
+    def checkout(self, host, port):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                idle = self.idle.get((host, port))
+                if not idle:
+                    return None
+                connection = idle.pop()
+            if not self.expired(connection, now) and connection.is_healthy():
+                return connection
+            connection.close()
+
+    def release(self, connection, response):
+        if response is not None and can_reuse(response) and connection.is_healthy():
+            with self.lock:
+                idle = self.idle.setdefault((connection.host, connection.port), [])
+                if len(idle) < self.max_size:
+                    idle.append(connection)
+                    return
+        connection.close()
+
+    # Close idle connections that have gone unused for too long
+    def evict_idle(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for idle in self.idle.values():
+                expired += [connection for connection in idle if self.expired(connection, now)]
+                idle[:] = [connection for connection in idle if connection not in expired]
+        for connection in expired:
+            connection.close()
+
+    def close(self):
+        with self.lock:
+            connections = [connection for idle in self.idle.values() for connection in idle]
+            self.idle.clear()
+        for connection in connections:
+            connection.close()
+
+    # Send a request on a pooled connection and return the response. A reused connection can turn out to have been
+    # closed by the server just as we sent on it; then the request is retried once on a new connection, provided
+    # nothing of the response had arrived.
+    def request(self, host, path, port=80, method="GET", headers=None, on_body=None, on_head=None):
+        self.evict_idle()
+        connection = self.checkout(host, port)
+        if connection is not None:
+            try:
+                response = connection.request(method, path, headers, on_body, on_head)
+            except Exception as e:
+                connection.close()
+                if not isinstance(e, (OSError, BadResponse)) or connection.parser.in_message():
+                    raise
+            else:
+                self.release(connection, response)
+                return response
+
+        connection = Connection(host, port, self.timeout)
+        response = None
+        try:
+            response = connection.request(method, path, headers, on_body, on_head)
+            return response
+        finally:
+            self.release(connection, response)
+
+    # Fetch many paths from one host with pipelined requests, at most `depth` outstanding on a connection at a time.
+    # Returns the responses in the order of paths.
+    def pipeline(self, host, paths, port=80, method="GET", headers=None, depth=32):
+        responses = []
+        while len(responses) < len(paths):
+            connection = self.checkout(host, port)
+            reused = connection is not None
+            if not reused:
+                connection = Connection(host, port, self.timeout)
+            batch = paths[len(responses):len(responses) + depth]
+            try:
+                received = connection.pipeline(method, batch, headers)
+            except (OSError, BadResponse):
+                connection.close()
+                if not reused or connection.parser.in_message():
+                    raise
+                continue  # A stale pooled connection, try again on a new one
+            responses += received
+            if len(received) == len(batch):
+                self.release(connection, received[-1])
+            else:
+                connection.close()
+                if not received and not reused:
+                    raise ConnectionError("connection closed before a response was received")
+        return responses
+
+
+# Send one request on a new connection and return the response. With on_body set, the body is passed to
+# on_body(view) piece by piece as it arrives and response.body stays empty. on_head(response) is called before that.
+def fetch(host, path, port=80, method="GET", headers=None, on_body=None, on_head=None, timeout=30):
+    connection = Connection(host, port, timeout)
+    try:
+        return connection.request(method, path, headers, on_body, on_head)
+    finally:
+        connection.close()
+
+
+# Stream a response body into a file, in constant memory whatever its size
+def download(host, path, filename, port=80, headers=None, timeout=30):
+    with open(filename, "wb") as f:
+        return fetch(host, path, port, headers=headers, on_body=f.write, timeout=timeout)
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+# Download a file over several connections at once. A HEAD request gives the size and whether the server accepts byte
+# ranges; the file is then split into ranges that `connections` threads fetch in parallel over pooled connections,
+# each written straight to its offset in the memory-mapped output file. Without range support, or for files no
+# bigger than one segment, this is a plain single-stream download.
+def segmented_download(host, path, filename, port=80, connections=4, segment_size=8 * 1024 * 1024, timeout=30):
+    # Ranges are of the unencoded file, so its size must be too
+    head = fetch(host, path, port, method="HEAD", headers={"Accept-Encoding": "identity"}, timeout=timeout)
+    size = head.headers.get("content-length", "")
+    if (head.status != 200 or head.headers.get("accept-ranges", "").lower() != "bytes" or not size.isdigit()
+            or int(size) <= segment_size or connections < 2):
+        return download(host, path, filename, port, timeout=timeout)
+    size = int(size)
+    segment_size = min(segment_size, -(-size // connections))  # At least one segment per connection
+    validator = head.headers.get("etag") or head.headers.get("last-modified")
+
+    with open(filename, "wb") as f:
+        f.truncate(size)
+    pool = ConnectionPool(max_size=connections, timeout=timeout)
+    try:
+        with open(filename, "r+b") as f, mmap.mmap(f.fileno(), size) as mapped:
+            def fetch_segment(first, last):
+                position = first
+
+                def check(response):
+                    expected = f"bytes {first}-{last}/{size}"
+                    if response.status != 206 or response.headers.get("content-range") != expected:
+                        raise RangesNotSupported(f"{response.status} {response.headers.get('content-range')}")
+
+                def write(view):
+                    nonlocal position
+                    mapped[position:position + len(view)] = view
+                    position += len(view)
+
+                headers = {"Range": f"bytes={first}-{last}"}
+                if validator:
+                    headers["If-Range"] = validator  # A changed file comes back whole and fails the check
+                pool.request(host, path, port, headers=headers, on_body=write, on_head=check)
+                if position != last + 1:
+                    raise ConnectionError(f"range {first}-{last} ended at {position}")
+
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                segments = [executor.submit(fetch_segment, first, min(first + segment_size, size) - 1)
+                            for first in range(0, size, segment_size)]
+                try:
+                    for segment in segments:
+                        segment.result()
+                except BaseException:
+                    for segment in segments:
+                        segment.cancel()  # Don't start ranges we are going to throw away
+                    raise
+    except RangesNotSupported:
+        return download(host, path, filename, port, timeout=timeout)
+    finally:
+        pool.close()
+    return head
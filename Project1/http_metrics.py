@@ -0,0 +1,157 @@
+# Request metrics and access logging for http_server.py.
+#
+# Both are built to stay off the request path. Metrics are recorded into a shard owned by the calling thread, so
+# recording takes no lock and touches nothing another thread writes; shards are only added up when /metrics is read.
+# The access log only appends a tuple to a queue per request. A background thread formats and writes the queued lines
+# once per flush_interval, in one write.
+
+import bisect
+import collections
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in seconds, from 100 us doubling up to about 26 s
+latency_buckets = [0.0001 * 2 ** i for i in range(19)]
+
+
+class RouteStats:
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets) + 1)  # The last bucket counts everything slower
+        self.seconds = 0.0
+
+
+# What one thread has recorded
+class Shard:
+    def __init__(self):
+        self.routes = {}  # route -> RouteStats
+        self.statuses = {}  # status code -> requests
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+class Metrics:
+    def __init__(self, max_routes=64):
+        self.max_routes = max_routes
+        self.known_routes = set()
+        self.local = threading.local()
+        self.shards = []
+        self.gauges = {}  # name -> function returning its current value
+        self.lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    # Requests are grouped by the first segment of their path. Past max_routes distinct routes the rest are counted
+    # as "other", so requests for random paths can't grow the histograms without bound.
+    def route(self, path):
+        path = path.split("?", 1)[0]
+        end = path.find("/", 1)
+        route = path if end == -1 else path[:end]
+        if route in self.known_routes:
+            return route
+        with self.lock:
+            if len(self.known_routes) < self.max_routes:
+                self.known_routes.add(route)
+                return route
+        return "other"
+
+    def observe(self, route, status, seconds, bytes_in, bytes_out):
+        shard = self.shard()
+        stats = shard.routes.get(route)
+        if stats is None:
+            stats = shard.routes[route] = RouteStats()
+        stats.counts[bisect.bisect_left(latency_buckets, seconds)] += 1
+        stats.seconds += seconds
+        shard.statuses[status] = shard.statuses.get(status, 0) + 1
+        shard.bytes_in += bytes_in
+        shard.bytes_out += bytes_out
+
+    # All shards added up, in the Prometheus text format
+    def render(self):
+        with self.lock:
+            shards = list(self.shards)
+        routes = {}
+        statuses = collections.Counter()
+        bytes_in = bytes_out = 0
+        for shard in shards:
+            for route, stats in list(shard.routes.items()):
+                total = routes.setdefault(route, RouteStats())
+                total.counts = [a + b for a, b in zip(total.counts, stats.counts)]
+                total.seconds += stats.seconds
+            statuses.update(dict(shard.statuses))
+            bytes_in += shard.bytes_in
+            bytes_out += shard.bytes_out
+
+        lines = ["# TYPE http_requests_total counter"]
+        lines += [f'http_requests_total{{status="{status}"}} {count}' for status, count in sorted(statuses.items())]
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        for route, stats in sorted(routes.items()):
+            label = route.replace("\\", "\\\\").replace('"', '\\"')
+            cumulative = 0
+            for bound, count in zip(latency_buckets + ["+Inf"], stats.counts):
+                cumulative += count
+                bound = bound if bound == "+Inf" else f"{bound:g}"
+                lines.append(f'http_request_duration_seconds_bucket{{route="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_sum{{route="{label}"}} {stats.seconds:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{route="{label}"}} {cumulative}')
+        lines += ["# TYPE http_received_bytes_total counter", f"http_received_bytes_total {bytes_in}",
+                  "# TYPE http_sent_bytes_total counter", f"http_sent_bytes_total {bytes_out}"]
+        for name, value in sorted(self.gauges.items()):
+            lines += [f"# TYPE {name} gauge", f"{name} {value()}"]
+        return ("\n".join(lines) + "\n").encode()
+
+
+# Access log in the Common Log Format, plus the time taken, e.g.
+#   127.0.0.1 - - [18/Oct/2026:14:21:24 +0000] "GET /index.html HTTP/1.1" 200 1043 0.412ms
+# The file is opened O_APPEND and each batch goes out in one write, so worker processes can share it.
+class AccessLog:
+    def __init__(self, path, flush_interval=1.0):
+        self.fd = 1 if path == "-" else os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.flush_interval = flush_interval
+        self.entries = collections.deque()  # Appends and pops are thread safe
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def request(self, client_address, request, status, sent, seconds):
+        self.entries.append((time.time(), client_address[0] if client_address else "-", request.method, request.path,
+                             request.version, status, sent, seconds))
+
+    def error(self, message):
+        self.entries.append((time.time(), message))
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        lines = []
+        date_second = None
+        while self.entries:
+            entry = self.entries.popleft()
+            if int(entry[0]) != date_second:
+                date_second = int(entry[0])
+                date = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(date_second))
+            if len(entry) == 2:
+                lines.append(f"[{date}] error: {entry[1]}\n")
+            else:
+                _, client, method, path, version, status, sent, seconds = entry
+                lines.append(f'{client} - - [{date}] "{method} {path} {version}" {status} {sent} '
+                             f'{seconds * 1000:.3f}ms\n')
+        data = memoryview("".join(lines).encode(errors="replace"))
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    # Write out what is queued and stop the writer thread
+    def close(self):
+        self.stopped.set()
+        self.writer.join()
+        if self.fd != 1:
+            os.close(self.fd)
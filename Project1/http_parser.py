@@ -0,0 +1,341 @@
+# Incremental HTTP/1.x message parser.
+#
+# Bytes are fed in whatever pieces the network delivers them, into one growable bytearray. Parsing picks up where the
+# previous call stopped: the search for the blank line ending the head never re-scans bytes it has already looked at,
+# and bodies framed by Content-Length or chunked transfer coding are decoded as their bytes arrive.
+
+from collections import deque
+
+# Headers that only apply to one connection, so are neither forwarded by a proxy nor stored by a cache
+hop_by_hop = {"connection", "keep-alive", "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade"}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class BadResponse(Exception):
+    pass
+
+
+# A parsed request. Header names are lowercased; body is a bytearray.
+class Request:
+    def __init__(self, method, path, version, headers):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = bytearray()
+
+
+# A parsed response. Header names are lowercased; body is a bytearray unless the parser streams it elsewhere.
+class ParsedResponse:
+    def __init__(self, version, status, reason, headers):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = bytearray()
+
+
+# Parse "Name: value" lines into a dict with lowercased names. Repeated headers are joined with commas.
+def parse_headers(lines, error=BadRequest):
+    headers = {}
+    for line in lines:
+        name, sep, value = line.partition(":")
+        if not sep or not name or name != name.strip():
+            raise error(f"malformed header line {line!r}")
+        name = name.lower()
+        value = value.strip()
+        headers[name] = headers[name] + ", " + value if name in headers else value
+    return headers
+
+
+# Parse the bytes before the blank line that ends the request head
+def parse_request_head(head):
+    try:
+        lines = head.decode("iso-8859-1").split("\r\n")
+        method, path, version = lines[0].split(" ")
+    except ValueError:
+        raise BadRequest("malformed request line")
+    if not version.startswith("HTTP/1."):
+        raise BadRequest(f"unsupported version {version}")
+    return Request(method, path, version, parse_headers(lines[1:]))
+
+
+# Parse the bytes before the blank line that ends the response head
+def parse_response_head(head):
+    try:
+        lines = head.decode("iso-8859-1").split("\r\n")
+        version, status, *reason = lines[0].split(" ", 2)
+        status = int(status)
+    except ValueError:
+        raise BadResponse("malformed status line")
+    if not version.startswith("HTTP/1."):
+        raise BadResponse(f"unsupported version {version}")
+    return ParsedResponse(version, status, reason[0] if reason else "", parse_headers(lines[1:], BadResponse))
+
+
+# How the body of a message is delimited: ("chunked", None), ("length", n) or ("none", None)
+def body_framing(headers, error=BadRequest):
+    transfer_encoding = headers.get("transfer-encoding")
+    if transfer_encoding is not None:
+        if transfer_encoding.lower() != "chunked":
+            raise error(f"unsupported Transfer-Encoding {transfer_encoding}")
+        return "chunked", None
+    length = headers.get("content-length")
+    if length is None:
+        return "none", None
+    if not length.isdigit():
+        raise error("invalid Content-Length")
+    return "length", int(length)
+
+
+# Frame one piece of a body for chunked transfer coding
+def encode_chunk(data):
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+# Base parser: owns the buffer and the body decoding state machine. Subclasses turn the head into a message and
+# say how its body is framed.
+#
+# Bodies are collected in message.body, or, when on_body is set, handed to on_body(view) as they arrive without being
+# collected, so a body of any size is parsed in the memory of the buffer. The view is only valid during the call.
+# on_head(message), if set, is called as soon as a head has been parsed, before any of its body.
+class MessageParser:
+    error = BadRequest
+
+    def __init__(self, max_header_bytes=65536, max_body_bytes=16 * 1024 * 1024, buffer_size=65536):
+        self.max_header_bytes = max_header_bytes
+        self.max_body_bytes = max_body_bytes  # Limit on collected bodies, streamed bodies are not limited
+        self.on_head = None
+        self.on_body = None
+        self.buffer = bytearray(buffer_size)
+        self.start = 0  # First byte not parsed yet
+        self.end = 0  # End of the bytes received so far
+        self.scan = 0  # Where the search for the end of the head resumes
+        self.message = None  # Message whose body is being read
+        self.state = "head"
+        self.remaining = 0  # Bytes left in the current body or chunk
+        self.received = 0  # Bytes fed in over the parser's lifetime
+
+    # Number of received bytes not consumed by a complete message yet
+    def buffered(self):
+        return self.end - self.start
+
+    # True while a message has been partly received
+    def in_message(self):
+        return self.message is not None or self.start != self.end
+
+    # Make room for `size` more bytes after end, first by moving the unparsed bytes to the front of the buffer. The
+    # buffer only grows when a single head or chunk line does not fit.
+    def reserve(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+        if self.start:
+            live = self.end - self.start
+            self.buffer[:live] = self.buffer[self.start:self.end]
+            self.end = live
+            self.scan -= self.start
+            self.start = 0
+        free = len(self.buffer) - self.end
+        if free < size:
+            self.buffer.extend(bytes(max(size - free, len(self.buffer))))
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        self.received += len(data)
+
+    # Receive straight into the free end of the buffer. Returns the number of bytes read, 0 once the peer has closed.
+    def recv_into(self, sock, min_size=4096):
+        self.reserve(min_size)
+        with memoryview(self.buffer)[self.end:] as view:
+            received = sock.recv_into(view)
+        self.end += received
+        self.received += received
+        return received
+
+    # Return the next complete message, or None if more bytes are needed
+    def next_message(self):
+        while True:
+            if self.state == "head":
+                if not self.parse_head():
+                    return None
+            elif self.state == "body":
+                self.read_body()
+                if self.remaining:
+                    return None
+                return self.finish()
+            elif self.state == "chunk-size":
+                if not self.parse_chunk_size():
+                    return None
+            elif self.state == "chunk-data":
+                self.read_body()
+                if self.remaining:
+                    return None
+                self.state = "chunk-end"
+            elif self.state == "chunk-end":
+                if self.end - self.start < 2:
+                    return None
+                if self.buffer[self.start:self.start + 2] != b"\r\n":
+                    raise self.error("missing CRLF after chunk")
+                self.start += 2
+                self.state = "chunk-size"
+            elif self.state == "trailers":
+                if not self.skip_trailers():
+                    return None
+                return self.finish()
+            elif self.state == "until-close":
+                self.remaining = self.end - self.start
+                self.read_body()
+                return None
+
+    # Called when the peer has closed the connection. Returns a message whose body ran until the close, or None.
+    def feed_eof(self):
+        if self.state == "until-close":
+            return self.finish()
+        if self.in_message():
+            raise self.error("connection closed mid-message")
+        return None
+
+    def parse_head(self):
+        # Tolerate blank lines between messages
+        while self.buffer.startswith(b"\r\n", self.start, self.end):
+            self.start += 2
+        self.scan = max(self.scan, self.start)
+        head_end = self.buffer.find(b"\r\n\r\n", self.scan, self.end)
+        if head_end == -1:
+            if self.end - self.start > self.max_header_bytes:
+                raise self.error("head too large")
+            self.scan = max(self.start, self.end - 3)
+            return False
+        if head_end - self.start > self.max_header_bytes:
+            raise self.error("head too large")
+
+        self.message = self.parse_message_head(bytes(self.buffer[self.start:head_end]))
+        self.start = head_end + 4
+        self.scan = self.start
+
+        framing, length = self.framing(self.message)
+        if self.on_head is not None:
+            self.on_head(self.message)  # May set on_body to take the body as it arrives
+        if framing == "chunked":
+            self.state = "chunk-size"
+        elif framing == "length":
+            if length > self.max_body_bytes and self.on_body is None:
+                raise self.error("body too large")
+            self.state = "body"
+            self.remaining = length
+        elif framing == "close":
+            self.state = "until-close"
+        else:
+            self.state = "body"
+            self.remaining = 0
+        return True
+
+    # Pass on what has arrived of the current body or chunk
+    def read_body(self):
+        take = min(self.remaining, self.end - self.start)
+        if not take:
+            return
+        with memoryview(self.buffer)[self.start:self.start + take] as view:
+            if self.on_body is not None:
+                self.on_body(view)
+            else:
+                if len(self.message.body) + take > self.max_body_bytes:
+                    raise self.error("body too large")
+                self.message.body += view
+        self.start += take
+        self.remaining -= take
+
+    def parse_chunk_size(self):
+        line_end = self.buffer.find(b"\r\n", self.start, self.end)
+        if line_end == -1:
+            if self.end - self.start > 1024:
+                raise self.error("chunk size line too long")
+            return False
+        size = self.buffer[self.start:line_end].split(b";")[0].strip()
+        try:
+            size = int(size, 16)
+        except ValueError:
+            raise self.error("invalid chunk size")
+        self.start = line_end + 2
+        if size == 0:
+            self.state = "trailers"
+        else:
+            self.state = "chunk-data"
+            self.remaining = size
+        return True
+
+    # Trailer fields after the last chunk are read and ignored
+    def skip_trailers(self):
+        if self.buffer.startswith(b"\r\n", self.start, self.end):
+            self.start += 2
+            return True
+        trailers_end = self.buffer.find(b"\r\n\r\n", self.start, self.end)
+        if trailers_end == -1:
+            if self.end - self.start > self.max_header_bytes:
+                raise self.error("trailers too large")
+            return False
+        self.start = trailers_end + 4
+        return True
+
+    def finish(self):
+        message = self.message
+        self.message = None
+        self.state = "head"
+        return message
+
+    def parse_message_head(self, head):
+        raise NotImplementedError
+
+    def framing(self, message):
+        raise NotImplementedError
+
+
+class RequestParser(MessageParser):
+    def parse_message_head(self, head):
+        return parse_request_head(head)
+
+    # Requests without Content-Length or Transfer-Encoding have no body
+    def framing(self, request):
+        return body_framing(request.headers)
+
+    def next_request(self):
+        return self.next_message()
+
+
+# Parses the responses to requests sent on one connection. Whether a response has a body depends on the request it
+# answers, so call expect(method) for each request in the order they were sent; GET is assumed otherwise.
+class ResponseParser(MessageParser):
+    error = BadResponse
+
+    def __init__(self, max_header_bytes=65536, max_body_bytes=16 * 1024 * 1024, buffer_size=65536):
+        super().__init__(max_header_bytes, max_body_bytes, buffer_size)
+        self.methods = deque()
+
+    def expect(self, method):
+        self.methods.append(method)
+
+    def parse_message_head(self, head):
+        response = parse_response_head(head)
+        if not 100 <= response.status < 200:
+            response.method = self.methods.popleft() if self.methods else "GET"
+        return response
+
+    # Responses to HEAD, 1xx, 204 and 304 never have a body. Without Content-Length or chunked coding, the body runs
+    # until the server closes the connection.
+    def framing(self, response):
+        if 100 <= response.status < 200 or response.status in (204, 304) or response.method == "HEAD":
+            return "none", None
+        framing, length = body_framing(response.headers, BadResponse)
+        return ("close", None) if framing == "none" else (framing, length)
+
+    # Interim 1xx responses are skipped
+    def next_response(self):
+        while True:
+            response = self.next_message()
+            if response is None or not 100 <= response.status < 200 or response.status == 101:
+                return response
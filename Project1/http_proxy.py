@@ -0,0 +1,264 @@
+# Reverse proxy and load balancer used by http_server.py --upstream.
+#
+# Each request goes to one of several backends, picked round robin or by fewest requests in flight. Upstream
+# connections are kept alive in an http_client.ConnectionPool and reused across clients. Bodies are streamed both
+# ways: a request body is forwarded as the client sends it, and a response body is passed on piece by piece as the
+# backend sends it, so neither is ever held in memory whole.
+#
+# Backends are health checked passively: connection errors, timeouts, malformed responses and 502/503/504 count as
+# failures, and a backend with max_failures in a row is left out for eject_seconds. After that it gets live traffic
+# again, and one more failure ejects it for another round.
+
+import threading
+import time
+
+from http_client import Connection, ConnectionPool
+from http_parser import BadResponse, body_framing, encode_chunk, hop_by_hop
+
+# Methods that are safe to send again if the backend failed before answering
+idempotent_methods = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def forwarded_headers(headers):
+    dropped = hop_by_hop | {name.strip().lower() for name in headers.get("connection", "").split(",")}
+    return [(name, value) for name, value in headers.items() if name not in dropped]
+
+
+class Backend:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.active = 0  # Requests in flight
+        self.failures = 0  # Failures in a row
+        self.ejected_until = 0.0
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+
+class LoadBalancer:
+    def __init__(self, backends, method="round-robin", timeout=30, pool_size=64, max_failures=3, eject_seconds=10,
+                 log=print):
+        self.backends = backends
+        self.log = log  # Called with a message when a backend is ejected
+        self.method = method
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.pool = ConnectionPool(max_size=pool_size, timeout=timeout)
+        self.lock = threading.Lock()
+        self.turn = 0
+
+    # Pick a backend for a request and count it as in flight there. Ejected backends are skipped while any other is
+    # up; if all of them are ejected, the one due back soonest is used rather than failing outright.
+    def acquire(self, exclude=()):
+        now = time.monotonic()
+        with self.lock:
+            candidates = [backend for backend in self.backends if backend not in exclude] or self.backends
+            available = [backend for backend in candidates if backend.ejected_until <= now]
+            if not available:
+                available = [min(candidates, key=lambda backend: backend.ejected_until)]
+            start = self.turn % len(available)
+            self.turn += 1
+            rotated = available[start:] + available[:start]  # Ties go to the next backend in turn
+            if self.method == "least-connections":
+                backend = min(rotated, key=lambda backend: backend.active)
+            else:
+                backend = rotated[0]
+            backend.active += 1
+        return backend
+
+    # A request to backend is over. ok is True on success, False on a backend failure and None when the outcome says
+    # nothing about the backend (the client went away).
+    def release(self, backend, ok):
+        ejected = False
+        with self.lock:
+            backend.active -= 1
+            if ok:
+                backend.failures = 0
+            elif ok is False:
+                backend.failures += 1
+                if backend.failures >= self.max_failures:
+                    ejected = backend.ejected_until <= time.monotonic()
+                    backend.ejected_until = time.monotonic() + self.eject_seconds
+        if ejected:
+            self.log(f"Backend {backend} failed {backend.failures} times in a row, ejecting it for {self.eject_seconds} s")
+
+    # Called from the request parser's on_head. A request with a body is sent upstream straight away and its body is
+    # forwarded as it arrives; one without is sent from respond(), where it can still be retried elsewhere.
+    def begin(self, request, parser, client_address):
+        request.upstream = None
+        parser.on_body = None
+        if body_framing(request.headers)[0] == "none":
+            return
+        exchange = Exchange(self, request, client_address)
+        exchange.send_head()
+        request.upstream = exchange
+        parser.on_body = exchange.send_body
+
+    # Get the response head for a fully received request. An idempotent request without a body that fails before
+    # any response arrived is retried: on a new connection if a pooled one had gone stale, else on another backend.
+    def respond(self, request, client_address):
+        exchange = request.upstream
+        if exchange is not None:
+            exchange.finish_request()
+            exchange.read_head()
+            return exchange
+
+        tried = []
+        while True:
+            exchange = Exchange(self, request, client_address, tried)
+            exchange.send_head()
+            exchange.read_head()
+            if exchange.head is not None or request.method not in idempotent_methods:
+                return exchange
+            if not exchange.stale:
+                tried.append(exchange.backend)
+            if len(tried) >= len(self.backends):
+                return exchange
+
+    # The client connection ended part way through a request whose body was being forwarded
+    def abandon(self, parser):
+        exchange = getattr(parser.message, "upstream", None)
+        if exchange is not None:
+            exchange.close()
+
+    def close(self):
+        self.pool.close()
+
+
+# One request proxied to a backend. Iterating over it yields the response body as the backend sends it.
+class Exchange:
+    def __init__(self, balancer, request, client_address, exclude=()):
+        self.balancer = balancer
+        self.request = request
+        self.client_address = client_address
+        self.backend = balancer.acquire(exclude)
+        self.connection = None
+        self.reused = False
+        self.stale = False  # Failed on a pooled connection the backend had closed, before any of a response
+        self.error = None
+        self.head = None
+        self.response = None  # The complete response, once its body has been read
+        self.pending = []  # Body pieces received but not passed on yet
+        self.chunked = body_framing(request.headers)[0] == "chunked"
+        self.released = False
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        if self.connection is not None:
+            self.stale = self.reused and not self.connection.parser.in_message()
+            self.connection.close()
+        self.done(None if self.stale else False)
+
+    def done(self, ok):
+        if not self.released:
+            self.released = True
+            self.balancer.release(self.backend, ok)
+
+    def request_head(self):
+        request = self.request
+        head = f"{request.method} {request.path} HTTP/1.1\r\n"
+        for name, value in forwarded_headers(request.headers):
+            if name != "x-forwarded-for" and not (self.chunked and name == "content-length"):
+                head += f"{name}: {value}\r\n"
+        forwarded_for = request.headers.get("x-forwarded-for")
+        client_ip = self.client_address[0]
+        head += f"X-Forwarded-For: {forwarded_for + ', ' if forwarded_for else ''}{client_ip}\r\n"
+        if self.chunked:
+            head += "Transfer-Encoding: chunked\r\n"
+        return (head + "\r\n").encode()
+
+    def send_head(self):
+        backend = self.backend
+        try:
+            self.connection = self.balancer.pool.checkout(backend.host, backend.port)
+            self.reused = self.connection is not None
+            if self.connection is None:
+                self.connection = Connection(backend.host, backend.port, self.balancer.timeout)
+            parser = self.connection.parser
+            parser.on_head = self.on_head
+            parser.on_body = self.on_body
+            parser.expect(self.request.method)
+            self.connection.sock.sendall(self.request_head())
+        except OSError as e:
+            self.fail(e)
+
+    # Forward a piece of the request body. After a failure the rest of the body is still read, and dropped, so the
+    # client connection stays in step.
+    def send_body(self, view):
+        if self.error is None:
+            try:
+                self.connection.sock.sendall(encode_chunk(view) if self.chunked else view)
+            except OSError as e:
+                self.fail(e)
+
+    def finish_request(self):
+        if self.error is None and self.chunked:
+            try:
+                self.connection.sock.sendall(b"0\r\n\r\n")
+            except OSError as e:
+                self.fail(e)
+
+    # Interim 1xx responses are dropped by the parser, so only keep the final head
+    def on_head(self, response):
+        if not 100 <= response.status < 200:
+            self.head = response
+
+    # Views into the parser's buffer are only valid during the call, so keep a copy until the client is sent it
+    def on_body(self, view):
+        self.pending.append(bytes(view))
+
+    # Receive more of the response. False once it is complete.
+    def receive(self):
+        parser = self.connection.parser
+        try:
+            self.response = parser.next_response()
+            if self.response is None and not parser.recv_into(self.connection.sock):
+                self.response = parser.feed_eof()
+                if self.response is None:
+                    raise ConnectionError("backend closed the connection mid-response")
+        except (OSError, BadResponse) as e:
+            self.fail(e)
+            raise ConnectionError(f"backend {self.backend}: {e}")
+        if self.response is None:
+            return True
+        parser.on_head = parser.on_body = None
+        self.balancer.pool.release(self.connection, self.response)
+        self.done(self.response.status not in (502, 503, 504))
+        return False
+
+    def read_head(self):
+        try:
+            while self.error is None and self.head is None and self.receive():
+                pass
+        except ConnectionError:
+            pass
+
+    # How the backend framed the response body: "none", "length", "chunked" or "close"
+    def framing(self):
+        return self.connection.parser.framing(self.head)[0]
+
+    def __iter__(self):
+        while True:
+            pieces, self.pending = self.pending, []
+            yield from pieces
+            if self.response is not None:
+                if not self.pending:
+                    return
+            elif not self.receive() and not self.pending:
+                return
+
+    # The client is gone, or the body was not wanted. A connection left mid-response can't be reused.
+    def close(self):
+        if self.response is None and self.connection is not None:
+            self.connection.close()
+        self.done(None)
+
+
+def parse_backend(value):
+    host, _, port = value.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"backend {value!r} is not HOST:PORT")
+    return Backend(host, int(port))
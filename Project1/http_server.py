@@ -1,30 +1,1092 @@
+import argparse
+import asyncio
+import email.utils
+import gzip
+import hashlib
+import html
+import mimetypes
+import mmap
+import os
+import signal
 import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISDIR
+from urllib.parse import quote, unquote, urlsplit
+
+from http_metrics import AccessLog, Metrics
+from http_parser import BadRequest, RequestParser, encode_chunk
+from http_proxy import LoadBalancer, forwarded_headers, parse_backend
 
 # Server configuration
 host = "127.0.0.1"
 port = 8080  # Ensure this port is not in use
+backlog = 1024  # Connections the kernel queues for us while every worker is busy
+workers = 64  # Clients served at the same time
+keep_alive_timeout = 5  # Seconds an idle persistent connection is kept open
+busy_keep_alive_timeout = 1  # Idle timeout once three quarters of max_connections are in use
+header_timeout = 10  # Seconds a client gets to send a whole request head once it has started one
+io_timeout = 30  # Seconds a request body read or a response write may stall before the client is dropped
+sendfile_piece_bytes = 1024 * 1024  # Async file bodies are sent in pieces of this size, each within io_timeout
+max_connections = 10000  # Clients served at once. Async mode turns more away with a 503; threads mode has --workers
+connections = 0  # Clients connected right now
+stopping = False  # Set once the server stops accepting, until another one starts; idle connections are closed then
+shutdown_timeout = 30  # Seconds async clients get to finish their requests when the server is stopped
+connections_lock = threading.Lock()
+max_keep_alive_requests = 100  # Requests served on one connection before we close it
+max_header_bytes = 65536  # Largest request head we are willing to buffer
+document_root = None  # Directory to serve files from. None serves the lab page below for every path.
+proxy = None  # LoadBalancer forwarding every request to backends, in proxy mode
+access_log = None  # AccessLog, when --access-log is given
+metrics = None  # Metrics served at /metrics, when --metrics is given
+cache_bytes = 64 * 1024 * 1024  # Memory budget for cached responses, 0 turns the cache off
+max_cache_entry_bytes = 1024 * 1024  # Larger files are always sent with sendfile instead
+min_compress_bytes = 256  # Smaller bodies barely shrink, and gzip adds about 20 bytes of its own
+
+# Body sent to every client when there is no document root
+body = "<html>Congratulations! You've downloaded the first Wireshark lab file!</html>\r\n".encode()
+body_etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+body_mtime = time.time()  # The page was "modified" when the server started
+body_last_modified = email.utils.formatdate(body_mtime, usegmt=True)
+
+
+# HTTP/1.1 connections are persistent unless the client says otherwise, HTTP/1.0 ones only if it asks
+def wants_keep_alive(request):
+    connection = request.headers.get("connection", "").lower()
+    if request.version == "HTTP/1.0":
+        return "keep-alive" in connection
+    return "close" not in connection
+
+
+reasons = {200: "OK", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request", 403: "Forbidden",
+           404: "Not Found", 405: "Method Not Allowed", 416: "Range Not Satisfiable", 502: "Bad Gateway",
+           504: "Gateway Timeout"}
+
+
+# Status, headers and body of a response. The body is either bytes, `length` bytes of an open file starting at
+# `offset`, which is sent straight from the page cache instead of being read into Python, or an iterable of byte
+# chunks. Chunks are sent with chunked transfer encoding as they are produced, so the body never has to be built in
+# memory and the client gets the first of it straight away. In async mode chunks can also be an async iterable.
+class Response:
+    def __init__(self, status, headers=None, body=b"", file=None, offset=0, length=0, chunks=None, reason=None):
+        self.status = status
+        self.reason = reason or reasons[status]
+        self.headers = headers if headers is not None else []
+        self.body = body
+        self.file = file
+        self.offset = offset
+        self.length = length if file is not None else len(body)
+        self.chunks = chunks
+        self.chunked = chunks is not None  # Cleared for HTTP/1.0 clients, who get the chunks until we close
+        self.cached = None  # CacheEntry holding this response already serialized
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.chunks is not None:
+            close = getattr(self.chunks, "close", None) or getattr(self.chunks, "aclose", None)
+            self.chunks = None
+            if close is not None:
+                return close()  # Stops a generator we did not run to the end. aclose() has to be awaited.
+
+
+def error_response(status):
+    message = f"{status} {reasons[status]}\r\n".encode()
+    return Response(status, [("Content-Type", "text/plain; charset=UTF-8")], message)
+
+
+def response_head(response, keep_alive):
+    head = f"HTTP/1.1 {response.status} {response.reason}\r\n"
+    for name, value in response.headers:
+        head += f"{name}: {value}\r\n"
+    if response.chunked:
+        head += "Transfer-Encoding: chunked\r\n"
+    elif response.chunks is None and response.status not in (204, 304):
+        head += f"Content-Length: {response.length}\r\n"
+    if keep_alive:
+        head += f"Connection: keep-alive\r\nKeep-Alive: timeout={keep_alive_timeout:g}, max={max_keep_alive_requests}\r\n"
+    else:
+        head += "Connection: close\r\n"
+    return (head + "\r\n").encode()
+
+
+# A response serialized once, both with and without keep-alive, so a hit is a single sendall of ready bytes
+class CacheEntry:
+    def __init__(self, validator, response):
+        self.validator = validator
+        self.headers = response.headers
+        self.size = 0
+        self.variants = {}  # keep_alive -> (head + body bytes, length of the head)
+        for keep_alive in (True, False):
+            head = response_head(response, keep_alive)
+            self.variants[keep_alive] = (head + response.body, len(head))
+            self.size += len(head) + response.length
+
+    # The body, without copying it out of the serialized response
+    def body(self):
+        data, head_length = self.variants[True]
+        return memoryview(data)[head_length:]
+
+
+# LRU cache of serialized responses keyed by path, bounded by the total bytes it holds. Entries carry a validator
+# (file mtime and size) and are dropped when the file on disk no longer matches it.
+class ResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, validator):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.validator != validator:
+                self.size -= entry.size
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, validator, response):
+        entry = CacheEntry(validator, response)
+        if entry.size > self.max_bytes:
+            return entry
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+        return entry
+
+
+response_cache = ResponseCache(cache_bytes)
+
+
+def cached_response(entry):
+    response = Response(200)
+    response.cached = entry
+    return response
+
+
+# True when the client's copy, identified by If-None-Match or If-Modified-Since, is still current
+def not_modified(request, etag, mtime):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def not_modified_response(etag, last_modified):
+    return Response(304, [("ETag", etag), ("Last-Modified", last_modified)])
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+# The byte range a request asks for as (first, last), or None for the whole file. Only single ranges are supported;
+# a list of ranges gets the whole file. If-Range makes the range conditional on the file being unchanged.
+def requested_range(request, etag, last_modified, size):
+    value = request.headers.get("range")
+    if value is None or not value.startswith("bytes=") or "," in value:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range not in (etag, last_modified):
+        return None
+
+    first, sep, last = value[len("bytes="):].strip().partition("-")
+    if not sep or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # Suffix range: the last `last` bytes
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - int(last)), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+def range_not_satisfiable(size):
+    response = error_response(416)
+    response.headers.append(("Content-Range", f"bytes */{size}"))
+    return response
+
+
+# Types worth compressing. Images, archives and the like are compressed already.
+compressible_types = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+
+def compressible(content_type):
+    return content_type.startswith(compressible_types)
+
+
+# True if the client takes gzip by its Accept-Encoding header: "gzip", "gzip;q=0.5" and "*" do, "gzip;q=0" doesn't
+def accepts_gzip(request):
+    accepted = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        params = params.strip()
+        try:
+            quality = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    return accepted.get("gzip", accepted.get("x-gzip", accepted.get("*", 0.0))) > 0
+
+
+# The gzip variant is a different representation, so it needs its own strong ETag
+def gzip_etag(etag):
+    return etag[:-1] + '-gzip"'
+
+
+# Compress a streamed body on the fly, flushing after each chunk so the client still gets data as it is produced
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def partial_headers(headers, first, last, size):
+    return headers + [("Content-Range", f"bytes {first}-{last}/{size}")]
+
+
+# Map a request path onto a file under the document root, refusing anything that escapes it. A directory maps to
+# its index.html if it has one.
+def resolve_path(path):
+    path = unquote(urlsplit(path).path)
+    root = os.path.realpath(document_root)
+    full_path = os.path.realpath(os.path.join(root, path.lstrip("/")))
+    if os.path.commonpath([root, full_path]) != root:
+        return None
+    index = os.path.join(full_path, "index.html")
+    if os.path.isfile(index):
+        full_path = index
+    return full_path
+
+
+# Stream an HTML list of a directory's entries as they are read, however many there are
+def directory_listing(request, directory):
+    path = urlsplit(request.path).path
+    if not path.endswith("/"):
+        path += "/"
+    title = html.escape(unquote(path))
+
+    def chunks():
+        yield f"<html><head><title>Index of {title}</title></head><body><h1>Index of {title}</h1><ul>\r\n".encode()
+        with os.scandir(directory) as entries:
+            batch = []
+            for entry in entries:
+                name = entry.name + ("/" if entry.is_dir() else "")
+                batch.append(f'<li><a href="{html.escape(path + quote(name))}">{html.escape(name)}</a></li>\r\n')
+                if len(batch) == 100:
+                    yield "".join(batch).encode()
+                    batch = []
+        yield ("".join(batch) + "</ul></body></html>\r\n").encode()
+
+    return Response(200, [("Content-Type", "text/html; charset=UTF-8")], chunks=chunks())
+
+
+def file_content_type(full_path):
+    content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+    if content_type.startswith("text/"):
+        content_type += "; charset=UTF-8"
+    return content_type
+
+
+# Stat of a precompressed "<file>.gz" next to the file, if there is one at least as new as the file
+def precompressed(full_path, stat):
+    try:
+        gzip_stat = os.stat(full_path + ".gz")
+    except OSError:
+        return None
+    return gzip_stat if gzip_stat.st_mtime_ns >= stat.st_mtime_ns else None
+
+
+# The gzip variant of a file, from its .gz sibling if it has one, otherwise compressed once and cached. Cached under
+# its own key next to the identity variant. None if the sibling has gone, then the file is sent as is.
+def serve_gzip(full_path, validator, gzip_stat, content_type, etag, last_modified):
+    key = (full_path, "gzip")
+    gzip_validator = (validator, gzip_stat and (gzip_stat.st_mtime_ns, gzip_stat.st_size))
+    entry = response_cache.get(key, gzip_validator)
+    if entry is not None:
+        return cached_response(entry)
+
+    headers = [("Content-Type", content_type), ("Content-Encoding", "gzip"), ("Vary", "Accept-Encoding"),
+               ("ETag", gzip_etag(etag)), ("Last-Modified", last_modified)]
+    try:
+        if gzip_stat is not None:
+            file = open(full_path + ".gz", "rb")
+            length = os.fstat(file.fileno()).st_size
+            if length > max_cache_entry_bytes or response_cache.max_bytes == 0:
+                return Response(200, headers, file=file, length=length)
+            with file:
+                data = file.read()
+        else:
+            with open(full_path, "rb") as file:
+                data = gzip.compress(file.read(), compresslevel=6, mtime=0)
+    except OSError:
+        return None
+    return cached_response(response_cache.put(key, gzip_validator, Response(200, headers, data)))
+
+
+def serve_file(request):
+    if request.method not in ("GET", "HEAD"):
+        response = error_response(405)
+        response.headers.append(("Allow", "GET, HEAD"))
+        return response
+
+    try:
+        full_path = resolve_path(request.path)
+    except ValueError:
+        return error_response(400)  # A path no file can have, such as one with a null byte
+    if full_path is None:
+        return error_response(403)
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return error_response(404)
+    except PermissionError:
+        return error_response(403)
+    if S_ISDIR(stat.st_mode):
+        return directory_listing(request, full_path)
+
+    validator = (stat.st_mtime_ns, stat.st_size)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+    # Compress when the client takes gzip and there is a .gz sibling or a small text file. Range requests always get
+    # the identity variant, so ranges keep meaning bytes of the file.
+    if "range" not in request.headers and accepts_gzip(request):
+        content_type = file_content_type(full_path)
+        gzip_stat = precompressed(full_path, stat)
+        if gzip_stat is not None or (compressible(content_type) and response_cache.max_bytes > 0
+                                     and min_compress_bytes <= stat.st_size <= max_cache_entry_bytes):
+            if not_modified(request, gzip_etag(etag), stat.st_mtime):
+                return not_modified_response(gzip_etag(etag), last_modified)
+            response = serve_gzip(full_path, validator, gzip_stat, content_type, etag, last_modified)
+            if response is not None:
+                return response
+
+    if not_modified(request, etag, stat.st_mtime):
+        return not_modified_response(etag, last_modified)
+
+    try:
+        byte_range = requested_range(request, etag, last_modified, stat.st_size)
+    except RangeNotSatisfiable:
+        return range_not_satisfiable(stat.st_size)
+
+    entry = response_cache.get(full_path, validator)
+    if entry is None:
+        try:
+            file = open(full_path, "rb")
+        except FileNotFoundError:
+            return error_response(404)
+        except (PermissionError, IsADirectoryError):
+            return error_response(403)
+
+        content_type = file_content_type(full_path)
+        headers = [("Content-Type", content_type), ("ETag", etag), ("Last-Modified", last_modified),
+                   ("Accept-Ranges", "bytes")]
+        if compressible(content_type) or os.path.exists(full_path + ".gz"):
+            headers.append(("Vary", "Accept-Encoding"))
+        length = os.fstat(file.fileno()).st_size
+        if length > max_cache_entry_bytes or response_cache.max_bytes == 0:
+            if byte_range is None:
+                return Response(200, headers, file=file, length=length)
+            first, last = byte_range
+            return Response(206, partial_headers(headers, first, last, length), file=file, offset=first,
+                            length=last - first + 1)
+
+        with file:
+            response = Response(200, headers, file.read())
+        entry = response_cache.put(full_path, validator, response)
+
+    if byte_range is None:
+        return cached_response(entry)
+    first, last = byte_range
+    return Response(206, partial_headers(entry.headers, first, last, stat.st_size), entry.body()[first:last + 1])
+
+
+def serve_page(request):
+    if not_modified(request, body_etag, body_mtime):
+        return not_modified_response(body_etag, body_last_modified)
+    entry = response_cache.get(None, body_etag)
+    if entry is None:
+        headers = [("Content-Type", "text/html; charset=UTF-8"), ("ETag", body_etag),
+                   ("Last-Modified", body_last_modified)]
+        entry = response_cache.put(None, body_etag, Response(200, headers, body))
+    return cached_response(entry)
+
+
+# Pass on a backend's response. Its body is streamed through as it arrives, keeping the backend's Content-Length
+# when it sent one and re-chunked otherwise.
+def proxy_response(request, client_address):
+    exchange = proxy.respond(request, client_address)
+    if exchange.head is None:
+        return error_response(504 if isinstance(exchange.error, socket.timeout) else 502)
+    head = exchange.head
+    framing = exchange.framing()
+    headers = [(name, value) for name, value in forwarded_headers(head.headers)
+               if not (name == "content-length" and framing in ("chunked", "close"))]
+    response = Response(head.status, headers, chunks=exchange, reason=head.reason)
+    response.chunked = framing in ("chunked", "close")
+    return response
+
 
-# Create and bind the socket
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+# Work out the response to a request. Nothing is sent here.
+def handle_request(request, client_address=None):
+    if metrics is not None and request.path == "/metrics":
+        return metrics_response(request)
+    if proxy is not None:
+        return proxy_response(request, client_address)
+    response = serve_file(request) if document_root is not None else serve_page(request)
+    if response.chunks is not None and hasattr(response.chunks, "__iter__"):
+        if compressible(dict(response.headers).get("Content-Type", "")):
+            response.headers.append(("Vary", "Accept-Encoding"))
+            if accepts_gzip(request):
+                response.headers.append(("Content-Encoding", "gzip"))
+                response.chunks = gzip_chunks(response.chunks)
+    return response
+
+
+# Current metrics in the Prometheus text format. Each --processes worker answers with its own.
+def metrics_response(request):
+    if request.method not in ("GET", "HEAD"):
+        return Response(405, [("Allow", "GET, HEAD")])
+    return Response(200, [("Content-Type", "text/plain; version=0.0.4"), ("Cache-Control", "no-store")],
+                    metrics.render())
+
+
+# Note a finished request in the metrics and the access log, whichever are on
+def record(client_address, request, status, seconds, received, sent):
+    if metrics is not None:
+        metrics.observe(metrics.route(request.path), status, seconds, received, sent)
+    if access_log is not None:
+        access_log.request(client_address, request, status, sent, seconds)
+
+
+# Errors go to the access log when there is one, else to stdout
+def log_error(message):
+    if access_log is not None:
+        access_log.error(message)
+    else:
+        print(message)
+
+
+# HTTP/1.0 has no chunked encoding, so a streamed body is sent as is and ends when we close the connection. Returns
+# whether the connection can stay open after the response.
+def prepare_response(request, response, keep_alive):
+    if response.chunks is not None and request.version == "HTTP/1.0":
+        response.chunked = False
+        return False
+    return keep_alive
+
+
+# Send a file body without copying it into Python bytes: os.sendfile where the platform has it, otherwise mmap the
+# file and send memoryview slices of the mapping
+def send_file(client_socket, file, offset, length):
+    if length == 0:
+        return
+    if hasattr(os, "sendfile"):
+        client_socket.sendfile(file, offset, length)
+        return
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            client_socket.sendall(view[offset:offset + length])
+
+
+def send_response(client_socket, request, response, keep_alive):
+    try:
+        if response.cached is not None:
+            data, head_length = response.cached.variants[keep_alive]
+            data = memoryview(data)[:head_length] if request.method == "HEAD" else data
+            client_socket.sendall(data)
+            return len(data)
+        head = response_head(response, keep_alive)
+        sent = len(head)
+        if request.method == "HEAD":
+            client_socket.sendall(head)
+        elif response.file is not None:
+            client_socket.sendall(head)
+            send_file(client_socket, response.file, response.offset, response.length)
+            sent += response.length
+        elif response.chunks is not None:
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send each chunk as it comes
+            client_socket.sendall(head)
+            for chunk in response.chunks:
+                if chunk:  # An empty chunk would end the body
+                    chunk = encode_chunk(chunk) if response.chunked else chunk
+                    client_socket.sendall(chunk)
+                    sent += len(chunk)
+            if response.chunked:
+                client_socket.sendall(b"0\r\n\r\n")
+                sent += 5
+        else:
+            client_socket.sendall(head + response.body)
+            sent += len(response.body)
+        return sent
+    finally:
+        response.close()
+
+
+bad_request_response = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+request_timeout_response = b"HTTP/1.1 408 Request Timeout\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+service_unavailable_response = (b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n"
+                                b"Connection: close\r\n\r\n")
+
+
+# Make closing the socket reset the connection, so a response the client stopped reading is dropped at once instead
+# of lingering in the kernel's send buffer
+def reset_on_close(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+
+
+# How long to wait for the next bytes of a request, raising socket.timeout once the client is out of time. Between
+# requests that is the keep-alive timeout, cut short while the server is busy so idle clients make room for active
+# ones; idle clients are looked at again every busy_keep_alive_timeout seconds in case it gets busy. Once a request has
+# started its whole head has to arrive by head_deadline, so a client trickling bytes can't hold on to a connection.
+# After that each read of the body gets io_timeout.
+def read_timeout(parser, waiting_since, head_deadline):
+    if parser.message is not None:
+        return io_timeout
+    now = time.monotonic()
+    if head_deadline is not None:
+        remaining = head_deadline - now
+    elif stopping:
+        raise socket.timeout("server shutting down")
+    else:
+        idle_timeout = keep_alive_timeout
+        if connections * 4 >= max_connections * 3:
+            idle_timeout = min(idle_timeout, busy_keep_alive_timeout)
+        remaining = min(waiting_since + idle_timeout - now, busy_keep_alive_timeout)
+    if remaining <= 0:
+        raise socket.timeout("request head took too long" if head_deadline is not None else "idle for too long")
+    return remaining
+
+
+# Read one request from the socket. Bytes past the end of it (a pipelined request) stay in the parser for the next
+# call. Returns None once the client has closed the connection.
+def read_request(client_socket, parser):
+    waiting_since = time.monotonic()
+    head_deadline = None
+    while True:
+        request = parser.next_request()
+        if request is not None:
+            return request
+        if head_deadline is None and parser.in_message():
+            head_deadline = time.monotonic() + header_timeout
+        client_socket.settimeout(read_timeout(parser, waiting_since, head_deadline))
+        try:
+            received = parser.recv_into(client_socket)
+        except socket.timeout:
+            if parser.message is not None:
+                raise
+            continue  # read_timeout says whether there is time left
+        if not received:
+            if parser.in_message():
+                raise BadRequest("connection closed mid-request")
+            return None
+
+
+# Serve a single client, runs on a worker thread. Requests are answered one at a time in the order they arrive, so
+# pipelined requests get their responses in order.
+def handle_client(client_socket, client_address):
+    with client_socket:
+        parser = RequestParser(max_header_bytes)
+        if proxy is not None:
+            parser.on_head = lambda request: proxy.begin(request, parser, client_address)
+        try:
+            serve_requests(client_socket, client_address, parser)
+        finally:
+            if proxy is not None:
+                proxy.abandon(parser)
+
+
+# Answer requests on a client connection until it closes, idles out or hits the request limit
+def serve_requests(client_socket, client_address, parser):
+    served = 0
+    counted = 0  # Bytes received that have been counted in the metrics
+    observed = metrics is not None or access_log is not None
+    while True:
+        try:
+            request = read_request(client_socket, parser)
+        except socket.timeout:
+            if parser.in_message():
+                client_socket.sendall(request_timeout_response)
+            break  # Idle for too long, or too slow sending a request
+        except BadRequest as e:
+            log_error(f"Bad request from {client_address}: {e}")
+            client_socket.sendall(bad_request_response)
+            break
+        if request is None:
+            break
+
+        started = time.perf_counter() if observed else 0
+        served += 1
+        keep_alive = wants_keep_alive(request) and served < max_keep_alive_requests
+        response = handle_request(request, client_address)
+        keep_alive = prepare_response(request, response, keep_alive)
+        client_socket.settimeout(io_timeout)
+        try:
+            sent = send_response(client_socket, request, response, keep_alive)
+        except socket.timeout:
+            reset_on_close(client_socket)
+            raise
+        if observed:
+            record(client_address, request, response.status, time.perf_counter() - started, parser.received - counted,
+                   sent)
+            counted = parser.received
+        if not keep_alive:
+            break
+
+
+# Create, bind and listen on the server socket. With reuse_port several processes can each bind their own socket to
+# the same port and the kernel spreads incoming connections across them.
+def create_server_socket(host, port, backlog, reuse_port=False):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Reuse the address
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((host, port))
-    server_socket.listen(1)  # Listen for one connection
-    print(f"Server is running at http://{host}:{port}/")
+    server_socket.listen(backlog)
+    return server_socket
+
+
+# Accept clients and hand them to a bounded pool of worker threads. We only accept when a worker is free, so
+# waiting clients stay in the kernel's listen backlog instead of piling up in an unbounded queue in Python.
+def serve(server_socket, workers):
+    global connections, stopping
+    stopping = False
+    free_workers = threading.BoundedSemaphore(workers)
+
+    def run(client_socket, client_address):
+        global connections
+        try:
+            handle_client(client_socket, client_address)
+        except OSError as e:
+            log_error(f"Connection from {client_address} failed: {e}")
+        except Exception as e:
+            log_error(f"Error serving {client_address}: {e!r}")  # The executor would drop it silently otherwise
+        finally:
+            with connections_lock:
+                connections -= 1
+            free_workers.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                free_workers.acquire()
+                try:
+                    client_socket, client_address = server_socket.accept()  # Server must accept clients socket and address
+                except OSError:
+                    free_workers.release()
+                    raise
+                with connections_lock:
+                    connections += 1
+                pool.submit(run, client_socket, client_address)
+        finally:
+            stopping = True
+            server_socket.close()  # Stop accepting, then let the pool finish the clients it already has
+
+
+# An async client's pending read and the monotonic time it has to complete by
+class AsyncClient:
+    def __init__(self, task):
+        self.task = task
+        self.deadline = None
+        self.timed_out = False
+
+
+async_clients = set()
+sweep_interval = 0.25  # Seconds between looks at the read deadlines of async clients
+sweepers = set()  # The running sweep_deadlines tasks, one per server, as the event loop only keeps weak references
+
 
+# Rather than arming a timer for every read, which costs more than the rest of reading a small request, one task per
+# server looks over all the pending reads a few times a second and cancels those that have run out of time. It stops
+# once the server is closed and the clients it had are gone.
+async def sweep_deadlines(server):
+    while server.is_serving() or async_clients:
+        await asyncio.sleep(sweep_interval)
+        now = time.monotonic()
+        for client in list(async_clients):
+            if client.deadline is not None and now >= client.deadline:
+                client.deadline = None
+                client.timed_out = True
+                client.task.cancel()
+
+
+# asyncio version of read_request. Raises socket.timeout when the client runs out of time.
+async def read_request_async(reader, parser, client):
+    waiting_since = time.monotonic()
+    head_deadline = None
     while True:
-        print("Waiting for a connection...")
-        client_socket, client_address = server_socket.accept() # Server must accept clients socket and address
-        print(f"Accepted connection from {client_address}")
-
-        with client_socket:
-            request = client_socket.recv(1024).decode() # Request decoding of client socket
-            print(f"Request received:\n{request}")
-
-            # Send HTTP response
-            data = (
-                "HTTP/1.1 200 OK\r\n"
-                "Content-Type: text/html; charset=UTF-8\r\n\r\n"
-                "<html>Congratulations! You've downloaded the first Wireshark lab file!</html>\r\n"
-            )
-            client_socket.sendall(data.encode())
-            print("Response sent. Closing connection.")
+        request = parser.next_request()
+        if request is not None:
+            return request
+        if head_deadline is None and parser.in_message():
+            head_deadline = time.monotonic() + header_timeout
+        client.deadline = time.monotonic() + read_timeout(parser, waiting_since, head_deadline)
+        try:
+            data = await reader.read(65536)
+        except asyncio.CancelledError:
+            if not client.timed_out:
+                raise
+            client.timed_out = False
+            if hasattr(client.task, "uncancel"):
+                client.task.uncancel()  # Python 3.11+ counts cancellations; this one has been dealt with
+            if parser.message is not None:
+                raise socket.timeout("request body stalled")
+            continue  # read_timeout says whether there is time left
+        finally:
+            client.deadline = None
+        if not data:
+            if parser.in_message():
+                raise BadRequest("connection closed mid-request")
+            return None
+        parser.feed(data)
+
+
+# Wait for the transport's buffer to fall below its high-water mark, dropping a client that stops reading. Below the
+# mark drain() doesn't block, so the timeout is only set up when it can be needed.
+async def drain(writer):
+    if writer.transport.get_write_buffer_size() > writer.transport.get_write_buffer_limits()[1]:
+        await asyncio.wait_for(writer.drain(), io_timeout)
+    else:
+        await writer.drain()
+
+
+# Write each chunk of a streamed body, waiting for the transport to drain so a slow client holds back the producer
+# instead of the chunks piling up in memory
+async def send_chunks_async(writer, response):
+    sent = 0
+
+    async def write(chunk):
+        nonlocal sent
+        if chunk:
+            chunk = encode_chunk(chunk) if response.chunked else chunk
+            writer.write(chunk)
+            sent += len(chunk)
+            await drain(writer)
+
+    if hasattr(response.chunks, "__aiter__"):
+        async for chunk in response.chunks:
+            await write(chunk)
+    else:
+        for chunk in response.chunks:
+            await write(chunk)
+    if response.chunked:
+        writer.write(b"0\r\n\r\n")
+        sent += 5
+    return sent
+
+
+# asyncio version of send_response. loop.sendfile() uses os.sendfile for file bodies where it can.
+async def send_response_async(writer, request, response, keep_alive):
+    try:
+        if response.cached is not None:
+            data, head_length = response.cached.variants[keep_alive]
+            data = memoryview(data)[:head_length] if request.method == "HEAD" else data
+            writer.write(data)
+            await drain(writer)
+            return len(data)
+        head = response_head(response, keep_alive)
+        writer.write(head)
+        sent = len(head)
+        if request.method == "HEAD":
+            pass
+        elif response.file is not None:
+            await drain(writer)
+            # In pieces, so a client that stops reading part way is caught within io_timeout
+            loop = asyncio.get_running_loop()
+            for offset in range(response.offset, response.offset + response.length, sendfile_piece_bytes):
+                count = min(sendfile_piece_bytes, response.offset + response.length - offset)
+                await asyncio.wait_for(loop.sendfile(writer.transport, response.file, offset, count), io_timeout)
+            sent += response.length
+        elif response.chunks is not None:
+            await drain(writer)
+            sent += await send_chunks_async(writer, response)
+        else:
+            writer.write(response.body)
+            sent += len(response.body)
+        await drain(writer)
+        return sent
+    finally:
+        closing = response.close()
+        if closing is not None:
+            await closing
+
+
+# asyncio version of handle_client. Coroutines instead of threads, so idle or slow clients cost a few KB each
+async def handle_client_async(reader, writer):
+    global connections
+    client_address = writer.get_extra_info("peername")
+    if connections >= max_connections:
+        writer.write(service_unavailable_response)  # Full: turn the client away cheaply instead of queueing it
+        writer.close()
+        return
+    connections += 1
+    client = AsyncClient(asyncio.current_task())
+    async_clients.add(client)
+    try:
+        parser = RequestParser(max_header_bytes)
+        served = 0
+        counted = 0
+        observed = metrics is not None or access_log is not None
+        while True:
+            try:
+                request = await read_request_async(reader, parser, client)
+            except socket.timeout:
+                if parser.in_message():
+                    writer.write(request_timeout_response)
+                break
+            except BadRequest as e:
+                log_error(f"Bad request from {client_address}: {e}")
+                writer.write(bad_request_response)
+                await drain(writer)
+                break
+            if request is None:
+                break
+
+            started = time.perf_counter() if observed else 0
+            served += 1
+            keep_alive = wants_keep_alive(request) and served < max_keep_alive_requests
+            response = handle_request(request)
+            keep_alive = prepare_response(request, response, keep_alive)
+            sent = await send_response_async(writer, request, response, keep_alive)
+            if observed:
+                record(client_address, request, response.status, time.perf_counter() - started,
+                       parser.received - counted, sent)
+                counted = parser.received
+            if not keep_alive:
+                break
+    except (OSError, asyncio.TimeoutError) as e:
+        if isinstance(e, (asyncio.TimeoutError, socket.timeout)):
+            reset_on_close(writer.get_extra_info("socket"))  # A write stalled
+            writer.transport.abort()
+        log_error(f"Connection from {client_address} failed: {str(e) or 'timed out'}")
+    finally:
+        connections -= 1
+        async_clients.discard(client)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+# Start the asyncio server on the running event loop. Callers that already have a loop can await this next to their
+# other services and keep the returned server to close it later.
+async def start_async_server(host, port, backlog, reuse_port=False):
+    global stopping
+    stopping = False
+    server = await asyncio.start_server(handle_client_async, host, port, backlog=backlog, reuse_address=True,
+                                        reuse_port=reuse_port or None)
+    sweeper = asyncio.ensure_future(sweep_deadlines(server))
+    sweepers.add(sweeper)
+    sweeper.add_done_callback(sweepers.discard)
+    return server
+
+
+# Serve until SIGTERM, then stop accepting and close the listening socket
+async def serve_async(host, port, backlog, reuse_port=False):
+    server = await start_async_server(host, port, backlog, reuse_port)
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        pass  # No signal handlers on this platform's event loop
+    async with server:
+        await stop.wait()
+
+    # Before Python 3.12 leaving the server doesn't wait for its clients, and asyncio.run() would cancel them mid
+    # response. Idle ones close within a read timeout of stopping being set, so only requests in progress hold us up.
+    global stopping
+    stopping = True
+    clients = [client.task for client in async_clients]
+    if clients:
+        await asyncio.wait(clients, timeout=shutdown_timeout)
+
+
+# Serve in this process with the selected mode. The access log's writer thread is started here rather than in main(),
+# so that each --processes worker has its own.
+def run_server(args, reuse_port=False):
+    global access_log, metrics
+    if args.metrics:
+        metrics = Metrics()
+        metrics.gauges["http_connections_active"] = lambda: connections
+    if args.access_log:
+        access_log = AccessLog(args.access_log)
+    try:
+        if args.mode == "async":
+            asyncio.run(serve_async(args.host, args.port, args.backlog, reuse_port))
+            return
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        with create_server_socket(args.host, args.port, args.backlog, reuse_port) as server_socket:
+            serve(server_socket, args.workers)
+    finally:
+        if access_log is not None:
+            access_log.close()
+
+
+# Fork a worker process running the server on its own SO_REUSEPORT socket
+def spawn_worker(args):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            run_server(args, reuse_port=True)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except BaseException as e:
+            print(f"Worker {os.getpid()} failed: {e}")
+            code = 1
+        finally:
+            sys.stdout.flush()
+            os._exit(code)
+    return pid
+
+
+# Pre-fork mode. The parent only supervises: it starts `processes` workers, replaces any that exit, restarts all of
+# them on SIGHUP, and on SIGTERM or Ctrl-C asks them to stop and waits for them to finish their clients.
+def run_prefork(args, processes):
+    workers_started = {}  # pid -> time the worker was started
+    stopping = False
+
+    def signal_workers():
+        for pid in list(workers_started):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        signal_workers()
+
+    def restart(signum, frame):
+        signal_workers()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, restart)
+
+    for _ in range(processes):
+        workers_started[spawn_worker(args)] = time.monotonic()
+
+    while workers_started:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = workers_started.pop(pid, None)
+        if started is None or stopping:
+            continue
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting it.")
+        if time.monotonic() - started < 1:
+            time.sleep(1)  # Don't spin if workers die as soon as they start
+        if not stopping:
+            workers_started[spawn_worker(args)] = time.monotonic()
+
+
+def main():
+    global keep_alive_timeout, max_keep_alive_requests, document_root, response_cache, proxy, header_timeout
+    global io_timeout, max_connections
+
+    parser = argparse.ArgumentParser(description="Simple HTTP server")
+    parser.add_argument("--host", default=host)
+    parser.add_argument("--port", type=int, default=port)
+    parser.add_argument("--backlog", type=int, default=backlog, help="listen() backlog")
+    parser.add_argument("--workers", type=int, default=workers, help="number of worker threads")
+    parser.add_argument("--mode", choices=["threads", "async"], default="threads",
+                        help="blocking sockets on a thread pool, or asyncio streams")
+    parser.add_argument("--keep-alive-timeout", type=float, default=keep_alive_timeout,
+                        help="seconds to keep an idle connection open")
+    parser.add_argument("--max-requests", type=int, default=max_keep_alive_requests,
+                        help="requests served per connection before closing it")
+    parser.add_argument("--header-timeout", type=float, default=header_timeout,
+                        help="seconds a client has to send a whole request head")
+    parser.add_argument("--io-timeout", type=float, default=io_timeout,
+                        help="seconds a request body read or response write may stall")
+    parser.add_argument("--max-connections", type=int, default=max_connections,
+                        help="async mode: clients served at once, more get a 503 (threads mode is capped by --workers)")
+    parser.add_argument("--root", help="serve files from this directory instead of the lab page")
+    parser.add_argument("--cache-bytes", type=int, default=cache_bytes,
+                        help="memory budget for cached responses, 0 disables the cache")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--upstream", action="append", metavar="HOST:PORT",
+                        help="proxy every request to this backend; repeat to balance across several")
+    parser.add_argument("--balance", choices=["round-robin", "least-connections"], default="round-robin",
+                        help="how proxy mode picks a backend for each request")
+    parser.add_argument("--access-log", metavar="PATH",
+                        help="log every request to this file, or - for stdout; written in batches once a second")
+    parser.add_argument("--metrics", action="store_true",
+                        help="serve request counts, latency histograms per route and byte counts at /metrics")
+    args = parser.parse_args()
+    if args.processes > 1 and not (hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork")):
+        parser.error("--processes needs SO_REUSEPORT and fork()")
+    if args.upstream:
+        if args.mode != "threads":
+            parser.error("--upstream needs --mode threads")
+        try:
+            proxy = LoadBalancer([parse_backend(value) for value in args.upstream], args.balance,
+                                 pool_size=args.workers, log=log_error)
+        except ValueError as e:
+            parser.error(str(e))
+    document_root = args.root
+    response_cache = ResponseCache(args.cache_bytes)
+    keep_alive_timeout = args.keep_alive_timeout
+    max_keep_alive_requests = args.max_requests
+    header_timeout = args.header_timeout
+    io_timeout = args.io_timeout
+    max_connections = args.max_connections if args.mode == "async" else args.workers
+
+    print(f"Server is running at http://{args.host}:{args.port}/")
+    try:
+        if args.processes > 1:
+            run_prefork(args, args.processes)
+        else:
+            run_server(args)
+    except KeyboardInterrupt:
+        pass
+    print("Shutting down.")
+
+
+if __name__ == "__main__":
+    main()
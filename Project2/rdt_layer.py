@@ -30,6 +30,9 @@ class RDTLayer(object):
     receiveChannel = None
     dataToSend = ''
     currentIteration = 0  # Use this for segment 'timeouts'
+    INITIAL_RTO = 3  # in iterations                     # Retransmission timeout before any round trip has been timed
+    MAX_RTO = 32  # in iterations                        # Limit on the timeout as it backs off
+    MAX_SACK_BLOCKS = 3                                  # Ranges of out-of-order data described in one ACK
 
     # Add items as needed
     sentData = ''
@@ -38,7 +41,6 @@ class RDTLayer(object):
     currSeqNum = 0
     expectedAck = 4
     serverData = []
-    flow_control_segs = 3
 
     # ################################################################################################################ #
     # __init__()                                                                                                       #
@@ -55,12 +57,18 @@ class RDTLayer(object):
 
         # Add items as needed
         self.countSegmentTimeouts = 0
-        self.seqnum = 0
+        self.sendBase = 0  # Oldest unacknowledged character; everything before it has been received
+        self.seqnum = 0  # Next character to send. Sequence numbers count characters, not segments
+        self.sendTimes = {}  # Iteration each unacknowledged segment was last sent in, by sequence number
+        self.retransmitted = set()  # Unacknowledged segments that have been sent more than once
+        self.sacked = set()  # Segments beyond sendBase the server has selectively acknowledged
+        self.srtt = None  # Smoothed round trip time, in iterations
+        self.rttvar = 0  # Round trip time variation
+        self.minRtt = None  # Shortest round trip time seen
+        self.rto = RDTLayer.INITIAL_RTO
         self.receiveData = ''
-        self.receiveArr = []
-        self.missingData = []
-        self.preMissing = 0  # 0 == false; 1 == true
-        self.currAck = 0
+        self.receiveBuffer = {}  # Segments received ahead of a gap, by sequence number
+        self.currAck = 0  # Next character expected; receiveData holds everything before it
         self.role = 0  # 0 == server; 1 == client
 
     # ################################################################################################################ #
@@ -95,9 +103,19 @@ class RDTLayer(object):
     # ################################################################################################################ #
     def setDataToSend(self, data):
         self.dataToSend = data
-        
-        # https://pythonexamples.org/python-split-string-into-specific-length-chunks/
-        splitData = [data[x:x + (RDTLayer.DATA_LENGTH)] for x in range(0, len(data), RDTLayer.DATA_LENGTH)]
+        if len(data) > 0:
+            self.role = 1
+
+    # ################################################################################################################ #
+    # getSegmentData()                                                                                                 #
+    #                                                                                                                  #
+    # Description:                                                                                                     #
+    # Returns the data of the segment starting at character seqnum. Segments start at multiples of DATA_LENGTH, so     #
+    # this is a slice of dataToSend by offset, and the data is never split up front                                    #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def getSegmentData(self, seqnum):
+        return self.dataToSend[seqnum:seqnum + self.DATA_LENGTH]
 
     # ################################################################################################################ #
     # getDataReceived()                                                                                                #
@@ -120,8 +138,8 @@ class RDTLayer(object):
     # ################################################################################################################ #
     def processData(self):
         self.currentIteration += 1
+        self.processReceiveAndSendRespond()  # ACKs first, so the window has already slid when we send
         self.processSend()
-        self.processReceiveAndSendRespond()
 
     # ################################################################################################################ #
     # processSend()                                                                                                    #
@@ -132,23 +150,113 @@ class RDTLayer(object):
     #                                                                                                                  #
     # ################################################################################################################ #
     def processSend(self):
-        splitData = [self.dataToSend[i:i + self.DATA_LENGTH] for i in range(0, len(self.dataToSend), self.DATA_LENGTH)]
-
-        if splitData != None:
-            self.role = 1
+        # Resending segments whose timer ran out. The timeout doubles for each round of timeouts, until an ACK for a
+        # segment sent only once gives a new round trip time.
+        timedOut = [seqnum for seqnum, sentAt in self.sendTimes.items() if self.currentIteration - sentAt >= self.rto]
+        if len(timedOut) > 0:
+            for seqnum in sorted(timedOut):
+                self.sendSegment(seqnum, self.getSegmentData(seqnum))
+                self.retransmitted.add(seqnum)
+
+                # As per instructors suggestion, keeping track of segment timeouts
+                self.countSegmentTimeouts += 1
+            self.rto = min(self.rto * 2, self.MAX_RTO)
+
+        # Sending new segments while the characters in flight fit in the flow control window
+        while self.seqnum < len(self.dataToSend):
+            payload = self.getSegmentData(self.seqnum)
+            if self.seqnum + len(payload) > self.sendBase + self.FLOW_CONTROL_WIN_SIZE:
+                break
+            self.sendSegment(self.seqnum, payload)
+            self.seqnum += len(payload)
 
-        if self.currentIteration == 1 and self.role == 1:
-            n = 0
-            # Sending data within the flow control window size
-            while n < self.flow_control_segs and n < len(splitData) - self.seqnum:
-                tempData = Segment()
-                tempData.setData(str(n + self.seqnum), splitData[n + self.seqnum])
-                print("Sending segment: ", tempData.to_string())
+    # ################################################################################################################ #
+    # sendSegment()                                                                                                    #
+    #                                                                                                                  #
+    # Description:                                                                                                     #
+    # Sends the data starting at character seqnum. Always in a new Segment, as the channel may have altered an old one #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def sendSegment(self, seqnum, payload):
+        tempData = Segment()
+        tempData.setData(str(seqnum), payload)
+        print("Sending segment: ", tempData.to_string())
+        self.sendChannel.send(tempData)
+        self.sendTimes[seqnum] = self.currentIteration
 
-                self.sendChannel.send(tempData)
-                n += 1
+    # ################################################################################################################ #
+    # processAck()                                                                                                     #
+    #                                                                                                                  #
+    # Description:                                                                                                     #
+    # Slides the window up to a cumulative ACK and times the round trip of the segments it acknowledges                #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def processAck(self, ack, blocks):
+        if ack > self.sendBase:
+            self.sendBase = ack
+            self.sacked = {seqnum for seqnum in self.sacked if seqnum >= ack}
+
+            # Karn's algorithm: an ACK for a segment that was sent more than once can't tell which copy arrived, so
+            # only segments sent once are timed
+            sample = None
+            for seqnum in sorted(self.sendTimes):
+                if seqnum >= ack:
+                    break
+                sentAt = self.sendTimes.pop(seqnum)
+                if seqnum in self.retransmitted:
+                    self.retransmitted.remove(seqnum)
+                else:
+                    sample = self.currentIteration - sentAt
+
+            # Jacobson/Karels estimate (RFC 6298), with a clock granularity of one iteration
+            if sample is not None:
+                self.minRtt = sample if self.minRtt is None else min(self.minRtt, sample)
+                if self.srtt is None:
+                    self.srtt = sample
+                    self.rttvar = sample / 2
+                else:
+                    self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+                    self.srtt = 0.875 * self.srtt + 0.125 * sample
+                self.rto = min(self.srtt + max(1, 4 * self.rttvar), self.MAX_RTO)
+
+        # Selectively acknowledged segments have arrived, so they are never resent. The server keeps what it has
+        # buffered, so blocks from an older, held up ACK are still true.
+        for start, end in blocks:
+            for seqnum in range(start, end, self.DATA_LENGTH):
+                if seqnum in self.sendTimes:
+                    del self.sendTimes[seqnum]
+                    self.retransmitted.discard(seqnum)
+                    self.sacked.add(seqnum)
+
+        # The server is missing the segment at the ACK number and any below data it has selectively acknowledged.
+        # One that has been out for at least the shortest round trip was lost or held up, so resend it now rather
+        # than wait for its timer. The smoothed round trip time would wait longer, as held up segments stretch it.
+        highest = max(self.sacked, default=ack)
+        for seqnum in sorted(self.sendTimes):
+            if seqnum > highest:
+                break
+            if self.currentIteration - self.sendTimes[seqnum] >= (self.minRtt or 1):
+                self.sendSegment(seqnum, self.getSegmentData(seqnum))
+                self.retransmitted.add(seqnum)
 
-            self.seqnum = n + self.seqnum
+    # ################################################################################################################ #
+    # getSackBlocks()                                                                                                  #
+    #                                                                                                                  #
+    # Description:                                                                                                     #
+    # Describes the data buffered beyond the first gap as "start-end" character ranges, end exclusive, e.g.            #
+    # "20-28,32-36". The ranges are the payload of the ACK segment.                                                    #
+    # ################################################################################################################ #
+    def getSackBlocks(self):
+        blocks = []
+        for seqnum in sorted(self.receiveBuffer):
+            end = seqnum + len(self.receiveBuffer[seqnum])
+            if len(blocks) > 0 and blocks[-1][1] == seqnum:
+                blocks[-1][1] = end
+            else:
+                blocks.append([seqnum, end])
+        return ','.join('{0}-{1}'.format(start, end) for start, end in blocks[:self.MAX_SACK_BLOCKS])
 
     # ################################################################################################################ #
     # processReceive()                                                                                                 #
@@ -163,96 +271,46 @@ class RDTLayer(object):
 
         listIncomingSegments = self.receiveChannel.receive()
 
-        sortedList = []
         receiveAck = []
-
-        splitData = [self.dataToSend[i:i + self.DATA_LENGTH] for i in range(0, len(self.dataToSend), self.DATA_LENGTH)]
-
-        for i in range(len(listIncomingSegments)):
-            listIncomingSegments[i].printToConsole()
-            sortedList.append(int(listIncomingSegments[i].seqnum))
-
-        sortedList.sort(reverse=True)
-
-        if len(splitData) == 0 and self.preMissing == 0:
-            for i in range(self.flow_control_segs):
-                self.receiveArr.append(None)
-
-        for i in range(len(sortedList)):
-            if sortedList[i] != -1:
-                for j in range(len(listIncomingSegments)):
-                    if listIncomingSegments[j].checkChecksum() == True and int(
-                            listIncomingSegments[j].seqnum) == sortedList[i] and self.receiveArr[sortedList[i]] == None:
-                        self.receiveArr[sortedList[i]] = listIncomingSegments[j].payload
-
-            else:
-                receiveAck.append(int(listIncomingSegments[i].acknum))
-
-        # Collect missing data
-        for i in range(len(self.receiveArr)):
-            if self.receiveArr[i] == None:
-                self.missingData.append(i)
-
-            elif self.missingData.count(i) > 0:
-                self.missingData.remove(i)
-
-        self.missingData = list(set(self.missingData))
-
-        if len(splitData) > 0:
+        sackBlocks = []
+
+        # Each segment's checksum is checked once. Data within the receive window is buffered by sequence number,
+        # whatever order it arrives in; duplicates and data already passed on are dropped.
+        for segment in listIncomingSegments:
+            segment.printToConsole()
+            if segment.checkChecksum() == False:
+                continue
+            seqnum = int(segment.seqnum)
+            if seqnum == -1:
+                receiveAck.append(int(segment.acknum))
+                for block in segment.payload.split(',') if segment.payload else []:
+                    start, end = block.split('-')
+                    sackBlocks.append((int(start), int(end)))
+            elif self.currAck <= seqnum < self.currAck + self.FLOW_CONTROL_WIN_SIZE:
+                self.receiveBuffer.setdefault(seqnum, segment.payload)
+
+        # Pass on the data that is now in order
+        inOrder = []
+        while self.currAck in self.receiveBuffer:
+            payload = self.receiveBuffer.pop(self.currAck)
+            inOrder.append(payload)
+            self.currAck += len(payload)
+        if len(inOrder) > 0:
+            self.receiveData += ''.join(inOrder)
+
+        if self.role == 1:
             if len(receiveAck) > 0:
-                dataMatchServer = 0
-                for i in range(len(receiveAck)):
-                    if receiveAck[i] == self.seqnum:
-                        dataMatchServer = 1
-
-                if dataMatchServer != 1:
-                    receiveAck.sort()
-                    for i in range(0, len(receiveAck)):
-                        if len(splitData) > receiveAck[i]:
-                            tempData = Segment()
-                            tempData.setData(str(receiveAck[i]), splitData[receiveAck[i]])
-                            print("Sending segment: ", tempData.to_string())
-                            self.sendChannel.send(tempData)
-
-                            # As per instructors suggestion, keeping track of segment timeouts
-                            self.countSegmentTimeouts += 1
-
-                elif self.currentIteration > 1:
-                    n = 0
-                    while n < (len(splitData) - self.seqnum) and n < self.flow_control_segs:
-                        tempData = Segment()
-                        tempData.setData(str(n + self.seqnum), splitData[n + self.seqnum])
-                        print("Sending segment: ", tempData.to_string())
-                        self.sendChannel.send(tempData)
-                        n += 1
-                    self.seqnum = n + self.seqnum
+                # ACKs are cumulative: everything before the ack number has arrived, so the window slides up to it
+                self.processAck(max(receiveAck), sackBlocks)
 
         else:
-            self.missingData.sort()
-            if len(self.missingData) == 0:
-                self.receiveData = ''
-                for i in range(len(self.receiveArr)):
-                    self.currAck = max(self.currAck, i)
-                    self.receiveData = self.receiveData + self.receiveArr[i]
-                self.currAck += 1
-                segmentAck.setAck(self.currAck)
-                self.sendChannel.send(segmentAck)
-                print("Sending ack: ", segmentAck.to_string())
-                self.preMissing = 0
-            else:
-                self.receiveData = ''
-                for x in range(self.missingData[0]):
-                    self.currAck = max(self.currAck, x)
-                    self.receiveData = self.receiveData + self.receiveArr[x]
-                for x in range(len(self.missingData)):
-                    temp = Segment()
-                    temp.setAck(self.missingData[x])
-                    self.sendChannel.send(temp)
-                    print("Sending ack: ", temp.to_string())
-
-                self.preMissing = 1
-
-
-    # Sources
-    # Python examples for splitting strings into specific length chunks: 
-    # https://pythonexamples.org/python-split-string-into-specific-length-chunks/
\ No newline at end of file
+            # One ACK per iteration, whether or not data arrived: with a window this small, the iterations without
+            # data are mostly the sender waiting on a lost ACK, and answering then beats waiting out its timer. The
+            # ACK covers the in-order data up to the first gap and carries the blocks received beyond it. The
+            # channel leaves ACK payloads alone, and setAck() clears the payload, so the checksum is worked out
+            # again over the blocks.
+            segmentAck.setAck(self.currAck)
+            segmentAck.payload = self.getSackBlocks()
+            segmentAck.checksum = segmentAck.calc_checksum(segmentAck.to_string())
+            self.sendChannel.send(segmentAck)
+            print("Sending ack: ", segmentAck.to_string())